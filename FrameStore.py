@@ -0,0 +1,104 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, glob, json, subprocess
+import numpy
+import cv2
+
+# ==================== FRAME SOURCES ====================
+
+# A frame source is indexed like a list of BGR uint8 images: len(frames) is the
+# number of frames and frames[i] the i-th one. Two are available: the JPEG dump
+# written to pyframes by ffmpeg, and a single raw memory-mapped file.
+
+STORE_NAME  = 'frames.raw'
+HEADER_SIZE = 4096
+
+class JpegFrames(object):
+
+    def __init__(self, frames_dir):
+
+        self.flist = sorted(glob.glob(os.path.join(frames_dir,'*.jpg')))
+
+    def __len__(self):
+
+        return len(self.flist)
+
+    def __getitem__(self, idx):
+
+        return cv2.imread(self.flist[idx])
+
+
+class FrameStore(object):
+
+    # Raw frames in one file: a JSON header (fps, shape, count) padded to
+    # HEADER_SIZE bytes, followed by count x H x W x 3 uint8 BGR frames. The
+    # frames are memory mapped, so repeated reads come from the page cache.
+
+    def __init__(self, path):
+
+        with open(path, 'rb') as fil:
+            header = json.loads(fil.read(HEADER_SIZE).rstrip(b'\0').decode())
+
+        self.fps    = header['fps']
+        self.shape  = tuple(header['shape'])
+        self.frames = numpy.memmap(path, dtype=numpy.uint8, mode='r', offset=HEADER_SIZE, shape=(header['count'],)+self.shape) if header['count'] > 0 else numpy.zeros((0,)+self.shape, dtype=numpy.uint8)
+
+    def __len__(self):
+
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+
+        # A writable copy, like the arrays cv2.imread returns
+        return numpy.array(self.frames[idx])
+
+    @staticmethod
+    def create(videofile, path, fps=25):
+
+        # Decode the video once with ffmpeg and write its frames to path
+
+        cap = cv2.VideoCapture(videofile)
+        w   = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        h   = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+
+        frame_bytes = h*w*3
+        count       = 0
+
+        command = ['ffmpeg','-loglevel','error','-i',videofile,'-f','rawvideo','-pix_fmt','bgr24','-']
+        proc    = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+        with open(path+'.tmp', 'wb') as fil:
+            fil.write(b'\0'*HEADER_SIZE)
+
+            while True:
+                data = proc.stdout.read(frame_bytes*25)
+                if not data:
+                    break
+                fil.write(data)
+                count += len(data)
+
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise RuntimeError('ffmpeg failed to decode %s'%videofile)
+
+            header = json.dumps({'fps':fps, 'shape':[h,w,3], 'count':count//frame_bytes}).encode()
+            fil.seek(0)
+            fil.write(header)
+
+        os.replace(path+'.tmp', path)
+
+        return FrameStore(path)
+
+
+def open_frames(frames_dir):
+
+    # The frame store if the pipeline wrote one, otherwise the JPEG dump
+
+    path = os.path.join(frames_dir, STORE_NAME)
+
+    if os.path.exists(path):
+        return FrameStore(path)
+
+    return JpegFrames(frames_dir)
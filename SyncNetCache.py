@@ -0,0 +1,98 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, glob, hashlib, json
+import numpy
+
+# ==================== FEATURE CACHE ====================
+
+class FeatureCache(object):
+
+    # On-disk cache of SyncNet embeddings. Each entry is a single float32 .npy
+    # holding [2 x T x D] (lip features, audio features), so it can be memory
+    # mapped. Keys hash the crop's bytes together with the model weights and the
+    # preprocessing parameters. Entries are touched on every hit and the least
+    # recently used ones are evicted once the cache grows beyond max_bytes.
+
+    def __init__(self, cache_dir, max_bytes=10*1024**3):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, videofile, model_hash, params):
+
+        h = hashlib.sha1()
+
+        with open(videofile, 'rb') as fil:
+            for block in iter(lambda: fil.read(1<<20), b''):
+                h.update(block)
+
+        h.update(model_hash.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+
+        return h.hexdigest()
+
+    def path(self, key):
+
+        return os.path.join(self.cache_dir, key+'.npy')
+
+    def get(self, key):
+
+        path = self.path(key)
+
+        try:
+            feats = numpy.load(path, mmap_mode='r')
+        except (IOError, ValueError):
+            return None
+
+        os.utime(path, None)
+
+        return feats[0], feats[1]
+
+    def put(self, key, im_feat, cc_feat):
+
+        path = self.path(key)
+        tmp  = '%s.%d.tmp' % (path, os.getpid())
+
+        with open(tmp, 'wb') as fil:
+            numpy.save(fil, numpy.stack((im_feat, cc_feat)).astype(numpy.float32))
+
+        os.replace(tmp, path)
+
+        self.evict()
+
+    def evict(self):
+
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npy')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def model_hash(state_dict):
+
+    # Hash of every tensor in a state dict, in name order
+
+    h = hashlib.sha1()
+
+    for name in sorted(state_dict.keys()):
+        h.update(name.encode())
+        h.update(state_dict[name].detach().cpu().contiguous().numpy().tobytes())
+
+    return h.hexdigest()
@@ -4,97 +4,561 @@
 
 import torch
 import numpy
-import time, pdb, argparse, subprocess, os, math, glob
+import time, pdb, argparse, subprocess, os, math, threading, pickle, hashlib, contextlib
 import cv2
-import python_speech_features
 
 from scipy import signal
 from scipy.io import wavfile
 from SyncNetModel import *
-from shutil import rmtree
+from SyncNetCache import FeatureCache, model_hash
+from SyncNetMFCC import MFCC
+from SyncNetOnnx import OnnxS, onnx_dir
 
 
 # ==================== Get OFFSET ====================
 
-def calc_pdist(feat1, feat2, vshift=10):
-    
-    win_size = vshift*2+1
+def calc_pdist(feat1, feat2, vshift=10, chunk_size=1024):
+
+    # Returns a [T x (2*vshift+1)] tensor: column k holds the distance between
+    # frame i of feat1 and frame i+k-vshift of feat2 (zero padded at the ends)
 
     feat2p = torch.nn.functional.pad(feat2,(0,0,vshift,vshift))
 
+    return calc_pdist_padded(feat1, feat2p, vshift=vshift, chunk_size=chunk_size)
+
+def calc_pdist_padded(feat1, feat2p, vshift=10, chunk_size=1024):
+
+    # As calc_pdist, but feat2p already holds vshift frames of context on each
+    # side of feat1, i.e. len(feat2p) == len(feat1)+2*vshift
+
+    win_size = vshift*2+1
+    eps      = 1e-6 # same eps as pairwise_distance, i.e. ||a - b + eps||
+
+    # Banded norm expansion: ||a-b+eps||^2 = |a|^2 + |b|^2 - 2ab + 2eps(sum a - sum b) + D eps^2
+    sq2 = (feat2p*feat2p).sum(1).unfold(0,win_size,1)
+    sm2 = feat2p.sum(1).unfold(0,win_size,1)
+
+    # Strided T x D x win_size view of every window, no copy of feat2p
+    windows = feat2p.unfold(0,win_size,1)
+
     dists = []
 
-    for i in range(0,len(feat1)):
+    for i in range(0,len(feat1),chunk_size):
+
+        f1  = feat1[i:i+chunk_size]
+        dot = torch.bmm(f1.unsqueeze(1),windows[i:i+chunk_size]).squeeze(1)
+
+        d2  = (f1*f1).sum(1,keepdim=True) + sq2[i:i+chunk_size] - 2*dot
+        d2  = d2 + 2*eps*(f1.sum(1,keepdim=True) - sm2[i:i+chunk_size]) + f1.size(1)*eps*eps
+
+        dists.append(d2.clamp(min=0).sqrt())
+
+    return torch.cat(dists,0)
+
+# ==================== LOAD VIDEO AND AUDIO ====================
+
+def video_size(videofile):
+
+    cap = cv2.VideoCapture(videofile)
+    width  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+
+    return width, height
+
+def read_pipe(pipe, chunk_size=1<<20):
+
+    # Everything left in pipe as a bytearray, so numpy.frombuffer gives a
+    # writable array that torch.from_numpy can wrap without a copy
+    buf = bytearray()
+
+    while True:
+        data = pipe.read(chunk_size)
+        if not data:
+            break
+        buf += data
+
+    return buf
+
+def load_av(videofile, sample_rate=16000):
+
+    # Decode BGR frames and mono s16le PCM with a single ffmpeg process. Video
+    # goes to stdout, audio to a second inherited pipe, both straight into numpy.
+
+    width, height = video_size(videofile)
+
+    audio_r, audio_w = os.pipe()
+
+    command = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-i', videofile,
+               '-map', '0:v:0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1',
+               '-map', '0:a:0', '-async', '1', '-ac', '1', '-ar', str(sample_rate), '-acodec', 'pcm_s16le', '-f', 's16le', 'pipe:%d' % audio_w]
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, pass_fds=(audio_w,))
+    os.close(audio_w)
+
+    # Drain the audio pipe concurrently, otherwise ffmpeg blocks once either pipe buffer fills up
+    audio_buf = []
+    with os.fdopen(audio_r, 'rb') as audio_pipe:
+        reader = threading.Thread(target=lambda: audio_buf.append(read_pipe(audio_pipe)))
+        reader.start()
+        video_buf = read_pipe(proc.stdout)
+        reader.join()
+
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError('ffmpeg failed to decode %s' % videofile)
+
+    images = numpy.frombuffer(video_buf, dtype=numpy.uint8).reshape(-1, height, width, 3)
+    audio  = numpy.frombuffer(audio_buf[0], dtype=numpy.int16)
+
+    return images, audio
+
+def load_video(videofile):
+
+    # Decode BGR frames only, for crops whose audio comes from elsewhere
+
+    width, height = video_size(videofile)
+
+    command = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-i', videofile,
+               '-map', '0:v:0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
 
-        dists.append(torch.nn.functional.pairwise_distance(feat1[[i],:].repeat(win_size, 1), feat2p[i:i+win_size,:]))
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    video_buf = read_pipe(proc.stdout)
 
-    return dists
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError('ffmpeg failed to decode %s' % videofile)
+
+    return numpy.frombuffer(video_buf, dtype=numpy.uint8).reshape(-1, height, width, 3)
+
+def stream_frames(videofile, chunk_size):
+
+    # Yield uint8 BGR frames from an ffmpeg pipe, at most chunk_size at a time
+
+    width, height = video_size(videofile)
+    frame_bytes   = width*height*3
+
+    command = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-i', videofile,
+               '-map', '0:v:0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    try:
+        while True:
+            chunk = numpy.empty((chunk_size, height, width, 3), dtype=numpy.uint8)
+            view  = memoryview(chunk).cast('B')
+
+            got = 0
+            while got < len(view):
+                n = proc.stdout.readinto(view[got:])
+                if not n:
+                    break
+                got += n
+
+            if got < frame_bytes:
+                break
+
+            yield chunk[:got//frame_bytes]
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+def stream_audio(videofile, chunk_size, sample_rate=16000):
+
+    # Yield mono int16 PCM from an ffmpeg pipe, at most chunk_size samples at a time
+
+    command = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-i', videofile,
+               '-map', '0:a:0', '-async', '1', '-ac', '1', '-ar', str(sample_rate), '-acodec', 'pcm_s16le', '-f', 's16le', 'pipe:1']
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    try:
+        while True:
+            buf = proc.stdout.read(chunk_size*2)
+            if len(buf) < 2:
+                break
+            yield numpy.frombuffer(buf[:len(buf)//2*2], dtype=numpy.int16)
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+# ==================== WINDOW BATCHES ====================
+
+def lip_clip(frames, nwin):
+
+    # uint8 [N x H x W x 3] frames -> float [1 x 3 x nwin+4 x H x W] clip holding
+    # nwin overlapping windows, for S.forward_lip_sequence
+    imtv = torch.from_numpy(frames[:nwin+4]).permute(3,0,1,2).unsqueeze(0)
+
+    return imtv.to(torch.float,memory_format=torch.contiguous_format)
+
+def aud_windows(mfcc, nwin):
+
+    # [13 x M] MFCC frames -> float [nwin x 1 x 13 x 20] audio input, 4 MFCC frames
+    # per video frame, as one strided unfold view and a single copy
+    cct = torch.as_tensor(mfcc[:,:nwin*4+16]).unfold(1,20,4)
+
+    return cct.permute(1,0,2).unsqueeze(1).to(torch.float,memory_format=torch.contiguous_format)
+
+# ==================== INFERENCE CONTEXT ====================
+
+def inference_context():
+
+    # torch.inference_mode skips view/version tracking on top of no_grad; older torch only has no_grad
+    if hasattr(torch,'inference_mode'):
+        return torch.inference_mode()
+
+    return torch.no_grad()
+
+# ==================== PRECISION ====================
+
+PRECISIONS = ['fp32', 'bf16', 'int8']
+
+def quantize_dynamic(model):
+
+    # INT8 weights for the Linear layers (netfcaud, netfclip), activations are
+    # quantized on the fly. The conv stacks have no dynamic quantized kernels and
+    # stay fp32. torch.quantization before torch 1.10.
+    quantization = torch.ao.quantization if hasattr(torch,'ao') else torch.quantization
+
+    return quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
 
 # ==================== MAIN DEF ====================
 
 class SyncNetInstance(torch.nn.Module):
 
-    def __init__(self, dropout = 0, num_layers_in_fc_layers = 1024):
+    def __init__(self, dropout = 0, num_layers_in_fc_layers = 1024, device = 'cuda', num_threads = 0, precision = 'fp32', backend = 'torch'):
         super(SyncNetInstance, self).__init__();
 
-        self.__S__ = S(num_layers_in_fc_layers = num_layers_in_fc_layers).cuda();
+        self.device = torch.device(device)
 
-    def evaluate(self, opt, videofile):
+        if precision not in PRECISIONS:
+            raise ValueError('Unknown precision %s, expected one of %s' % (precision,', '.join(PRECISIONS)))
 
-        self.__S__.eval();
+        if precision == 'int8' and self.device.type != 'cpu':
+            raise ValueError('int8 precision is only available on cpu')
 
-        # ========== ==========
-        # Convert files
-        # ========== ==========
+        if backend not in ['torch', 'onnx']:
+            raise ValueError('Unknown backend %s, expected torch or onnx' % backend)
+
+        if backend == 'onnx' and precision != 'fp32':
+            raise ValueError('The onnx backend runs in fp32 only')
+
+        self.precision   = precision
+        self.backend     = backend
+        self.num_threads = num_threads
+
+        if self.device.type == 'cpu' and num_threads > 0:
+            torch.set_num_threads(num_threads)
+
+        self.__S__ = S(num_layers_in_fc_layers = num_layers_in_fc_layers).to(self.device);
+        self.__M__ = MFCC().to(self.device);
+
+        self.model_hash = None
+
+    def feature_params(self):
+
+        # Everything besides the crop and the weights that changes the embeddings
+        params = {'version': 1, 'sample_rate': 16000, 'frame_rate': 25, 'numcep': 13}
+
+        if self.precision != 'fp32':
+            params['precision'] = self.precision
+
+        if self.backend != 'torch':
+            params['backend'] = self.backend
+
+        return params
+
+    def inference_context(self):
+
+        # inference_context(), under bf16 autocast for precision bf16. Outputs may
+        # then be bf16 and are converted back with .float().
+
+        stack = contextlib.ExitStack()
+        stack.enter_context(inference_context())
+
+        if self.precision == 'bf16':
+            stack.enter_context(torch.autocast(device_type=self.device.type, dtype=torch.bfloat16))
+
+        return stack
 
-        if os.path.exists(os.path.join(opt.tmp_dir,opt.reference)):
-          rmtree(os.path.join(opt.tmp_dir,opt.reference))
+    def mfcc_frames(self, audio, start=0, num_frames=None):
 
-        os.makedirs(os.path.join(opt.tmp_dir,opt.reference))
+        # MFCC frames [start, start+num_frames) of the whole int16 signal audio, all
+        # of them if num_frames is None, as a [13 x F] tensor on the device. Only
+        # the samples they cover are read, plus one before for pre-emphasis, so the
+        # result matches python_speech_features.mfcc over the full signal.
 
-        command = ("ffmpeg -y -i %s -threads 1 -f image2 %s" % (videofile,os.path.join(opt.tmp_dir,opt.reference,'%06d.jpg'))) 
-        output = subprocess.call(command, shell=True, stdout=None)
+        first = start*160
+        last  = len(audio) if num_frames is None else first+(num_frames-1)*160+400
+        seg   = torch.from_numpy(numpy.array(audio[max(first-1,0):last], dtype=numpy.int16)).to(self.device)
 
-        command = ("ffmpeg -y -i %s -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 %s" % (videofile,os.path.join(opt.tmp_dir,opt.reference,'audio.wav'))) 
-        output = subprocess.call(command, shell=True, stdout=None)
+        if first > 0:
+            return self.__M__(seg[1:], prev=seg[:1])[0]
+
+        return self.__M__(seg)[0]
+
+    def feature_cache(self, opt):
+
+        if not getattr(opt,'cache_dir','') or self.model_hash is None:
+            return None
+
+        return FeatureCache(opt.cache_dir, max_bytes=int(getattr(opt,'cache_size',10)*1024**3))
+
+    def cache_key(self, cache, videofile, mfcc=None, audio_key=None):
+
+        # audio_key (see track_audio_keys) names audio taken from elsewhere without
+        # computing it; otherwise given MFCC frames are hashed themselves
+        params = self.feature_params()
+        if audio_key is not None:
+            params['audio'] = audio_key
+        elif mfcc is not None:
+            params['audio'] = hashlib.sha1(numpy.ascontiguousarray(torch.as_tensor(mfcc).cpu().numpy()).tobytes()).hexdigest()
+
+        return cache.key(videofile, self.model_hash, params)
+
+    def calc_offset(self, opt, im_feat, cc_feat):
+
+        dists = calc_pdist(im_feat,cc_feat,vshift=opt.vshift)
+        mdist = torch.mean(dists,0)
+
+        minval, minidx = torch.min(mdist,0)
+
+        offset = opt.vshift-minidx
+        conf   = torch.median(mdist) - minval
+
+        fdist   = dists[:,minidx].numpy()
+        # fdist   = numpy.pad(fdist, (3,3), 'constant', constant_values=15)
+        fconf   = torch.median(mdist).numpy() - fdist
+        fconfm  = signal.medfilt(fconf,kernel_size=9)
         
+        numpy.set_printoptions(formatter={'float': '{: 0.3f}'.format})
+        print('Framewise conf: ')
+        print(fconfm)
+        print('AV offset: \t%d \nMin dist: \t%.3f\nConfidence: \t%.3f' % (offset,minval,conf))
+
+        return offset.numpy(), conf.numpy(), dists.numpy()
+
+    def evaluate(self, opt, videofile, mfcc=None, cc_feat=None):
+
+        # mfcc [13 x M] and cc_feat (audio embeddings of the windows of mfcc), if
+        # given, are used instead of the crop's own audio track; see track_audio
+
+        self.__S__.eval();
+
         # ========== ==========
-        # Load video 
+        # Features, from the cache when the crop and model are unchanged
         # ========== ==========
 
-        images = []
-        
-        flist = glob.glob(os.path.join(opt.tmp_dir,opt.reference,'*.jpg'))
-        flist.sort()
+        cache = self.feature_cache(opt)
+        feats = None
 
-        for fname in flist:
-            images.append(cv2.imread(fname))
+        if cache is not None:
+            key   = self.cache_key(cache, videofile, mfcc)
+            feats = cache.get(key)
 
-        im = numpy.stack(images,axis=3)
-        im = numpy.expand_dims(im,axis=0)
-        im = numpy.transpose(im,(0,3,4,1,2))
+        if feats is not None:
+            im_feat = torch.from_numpy(numpy.array(feats[0]))
+            cc_feat = torch.from_numpy(numpy.array(feats[1]))
+            print('Cached features loaded for %s' % videofile)
+        elif getattr(opt,'stream',False):
+            im_feat, cc_feat = self.evaluate_feats_stream(opt, videofile, mfcc, cc_feat)
+        else:
+            im_feat, cc_feat = self.evaluate_feats(opt, videofile, mfcc, cc_feat)
 
-        imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
+        if cache is not None and feats is None:
+            cache.put(key, im_feat.numpy(), cc_feat.numpy())
 
         # ========== ==========
-        # Load audio
+        # Compute offset
         # ========== ==========
 
-        sample_rate, audio = wavfile.read(os.path.join(opt.tmp_dir,opt.reference,'audio.wav'))
-        mfcc = zip(*python_speech_features.mfcc(audio,sample_rate))
-        mfcc = numpy.stack([numpy.array(i) for i in mfcc])
+        return self.calc_offset(opt, im_feat, cc_feat)
+
+    def evaluate_many(self, opt, videofiles, inputs=None, audio_keys=None):
+
+        # evaluate() for several crops at once, of one video or of several.
+        # inputs[i] holds the keyword arguments (mfcc, cc_feat) evaluate() would get
+        # for videofiles[i]. inputs may also be a function that returns them for a
+        # list of crop indices, in which case it is only called for the crops not in
+        # the cache, and audio_keys[i] stands for the audio of crop i in the cache
+        # key. Returns one (offset, conf, dists) per crop.
+
+        self.__S__.eval();
+
+        inputs     = inputs if inputs is not None else [{}]*len(videofiles)
+        audio_keys = audio_keys if audio_keys is not None else [None]*len(videofiles)
+        cache      = self.feature_cache(opt)
+        keys       = [None]*len(videofiles)
+        feats      = [None]*len(videofiles)
+
+        if cache is not None:
+            for i, videofile in enumerate(videofiles):
+                mfcc    = None if callable(inputs) or audio_keys[i] is not None else inputs[i].get('mfcc')
+                keys[i] = self.cache_key(cache, videofile, mfcc, audio_keys[i])
+                cached  = cache.get(keys[i])
+                if cached is not None:
+                    feats[i] = (torch.from_numpy(numpy.array(cached[0])), torch.from_numpy(numpy.array(cached[1])))
+                    print('Cached features loaded for %s' % videofile)
+
+        todo  = [ i for i in range(len(videofiles)) if feats[i] is None ]
+        fresh = []
+
+        if todo:
+            todo_inputs = inputs(todo) if callable(inputs) else [ inputs[i] for i in todo ]
+            fresh       = self.evaluate_feats_many(opt, [ videofiles[i] for i in todo ], todo_inputs)
+
+        for i, feat in zip(todo, fresh):
+            feats[i] = feat
+            if cache is not None:
+                cache.put(keys[i], feat[0].numpy(), feat[1].numpy())
+
+        return [ self.calc_offset(opt, im_feat, cc_feat) for im_feat, cc_feat in feats ]
+
+    def track_ranges(self, opt, num_crops):
+
+        # [start, end) frame range of each of the num_crops face track crops of
+        # opt.reference and the source audio.wav, or None if the pipeline outputs
+        # do not match the crops
+
+        trackfile = os.path.join(opt.work_dir,opt.reference,'tracks.pckl')
+        audiofile = os.path.join(opt.avi_dir,opt.reference,'audio.wav')
+
+        if not (os.path.exists(trackfile) and os.path.exists(audiofile)):
+            return None
+
+        with open(trackfile, 'rb') as fil:
+            tracks = pickle.load(fil)
+
+        if len(tracks) != num_crops:
+            return None
+
+        return [ (int(track['track']['frame'][0]), int(track['track']['frame'][-1])+1) for track in tracks ], audiofile
+
+    def track_audio_keys(self, opt, num_crops):
 
-        cc = numpy.expand_dims(numpy.expand_dims(mfcc,axis=0),axis=0)
-        cct = torch.autograd.Variable(torch.from_numpy(cc.astype(float)).float())
+        # Cache identity of the track_audio inputs of each crop: a hash of audio.wav
+        # and the track's frame range, without computing any audio features. None
+        # for crops that use their own audio.
+
+        found = self.track_ranges(opt, num_crops)
+
+        if found is None:
+            return [None]*num_crops
+
+        ranges, audiofile = found
+
+        wavhash = hashlib.sha1()
+        with open(audiofile, 'rb') as fil:
+            for block in iter(lambda: fil.read(1<<20), b''):
+                wavhash.update(block)
+
+        return [ '%s:%d-%d' % (wavhash.hexdigest(),start,end) for start, end in ranges ]
+
+    def track_audio(self, opt, num_crops, crops=None):
+
+        # evaluate() audio inputs for the num_crops face track crops of opt.reference,
+        # taken from pyavi/<reference>/audio.wav rather than from each crop. MFCC and
+        # audio embeddings are computed once per span of overlapping tracks and
+        # sliced by frame range, 4 MFCC frames per video frame. Empty dicts (use the
+        # crop's own audio) if the pipeline outputs do not match the crops. With
+        # crops, a list of crop indices, only the inputs of those crops are returned
+        # and only the spans holding them are computed.
+
+        self.__S__.eval();
+
+        crops = list(range(num_crops)) if crops is None else crops
+        found = self.track_ranges(opt, num_crops)
+
+        if found is None:
+            return [{}]*len(crops)
+
+        ranges, audiofile = found
+
+        spans = []
+        for start, end in sorted(ranges):
+            if spans and start <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1],end)
+            else:
+                spans.append([start,end])
+
+        sample_rate, audio = wavfile.read(audiofile, mmap=True)
+
+        needed = [ ranges[idx] for idx in crops ]
+        spans  = [ span for span in spans if any(span[0] <= start and end <= span[1] for start, end in needed) ]
+
+        tS = time.time()
+        span_feats = []
+        with self.inference_context():
+            for start, end in spans:
+
+                # One column per 160 samples, as the cut audio of a crop would have.
+                # The last columns of the signal only pad the count; no window reads them.
+                ncols = max(min((end-start)*4,(len(audio)-start*640)//160),0)
+                mfcc  = self.mfcc_frames(audio,start*4,ncols)[:,:ncols]
+                if mfcc.shape[1] < ncols:
+                    mfcc = torch.nn.functional.pad(mfcc.unsqueeze(0),(0,ncols-mfcc.shape[1]),mode='replicate')[0]
+                nwin  = ncols//4-5
+
+                cc_feat = []
+                for i in range(0,nwin,opt.batch_size):
+                    cc_in = aud_windows(mfcc[:,i*4:],min(nwin,i+opt.batch_size)-i)
+                    cc_out  = self.__S__.forward_aud(cc_in.to(self.device))
+                    cc_feat.append(cc_out.float().cpu())
+
+                span_feats.append((start, end, mfcc, torch.cat(cc_feat,0) if cc_feat else None))
+
+        print('Audio features for %d tracks in %d spans, %.3f sec.' % (len(crops),len(spans),time.time()-tS))
+
+        del audio
+
+        inputs = []
+        for start, end in needed:
+            span_start, span_end, mfcc, cc_feat = next(span for span in span_feats if span[0] <= start and end <= span[1])
+            first = start-span_start
+            inputs.append({'mfcc': mfcc[:,first*4:(first+end-start)*4],
+                           'cc_feat': cc_feat[first:] if cc_feat is not None else None})
+
+        return inputs
+
+    def evaluate_feats(self, opt, videofile, mfcc=None, cc_given=None):
+
+        self.__S__.eval();
+
+        if mfcc is None:
+
+            # ========== ==========
+            # Load video and audio
+            # ========== ==========
+
+            images, audio = load_av(videofile)
+
+            # ========== ==========
+            # Load audio
+            # ========== ==========
+
+            mfcc = self.mfcc_frames(audio)
+
+            num_samples = len(audio)
+
+        else:
+
+            # Audio features sliced from the source, 160 samples per MFCC frame
+            images = load_video(videofile)
+            num_samples = mfcc.shape[1]*160
 
         # ========== ==========
         # Check audio and video input length
         # ========== ==========
 
-        if (float(len(audio))/16000) != (float(len(images))/25) :
-            print("WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."%(float(len(audio))/16000,float(len(images))/25))
+        if (float(num_samples)/16000) != (float(len(images))/25) :
+            print("WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."%(float(num_samples)/16000,float(len(images))/25))
 
-        min_length = min(len(images),math.floor(len(audio)/640))
+        min_length = min(len(images),math.floor(num_samples/640))
         
         # ========== ==========
         # Generate video and audio feats
@@ -105,51 +569,220 @@ class SyncNetInstance(torch.nn.Module):
         cc_feat = []
 
         tS = time.time()
-        for i in range(0,lastframe,opt.batch_size):
-            
-            im_batch = [ imtv[:,:,vframe:vframe+5,:,:] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            im_in = torch.cat(im_batch,0)
-            im_out  = self.__S__.forward_lip(im_in.cuda());
-            im_feat.append(im_out.data.cpu())
+        with self.inference_context():
+            for i in range(0,lastframe,opt.batch_size):
+
+                nwin = min(lastframe,i+opt.batch_size)-i
+
+                im_in = lip_clip(images[i:],nwin)
+                im_out  = self.__S__.forward_lip_sequence(im_in.to(self.device));
+                im_feat.append(im_out.float().cpu())
 
-            cc_batch = [ cct[:,:,:,vframe*4:vframe*4+20] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            cc_in = torch.cat(cc_batch,0)
-            cc_out  = self.__S__.forward_aud(cc_in.cuda())
-            cc_feat.append(cc_out.data.cpu())
+                if cc_given is not None:
+                    cc_feat.append(cc_given[i:i+nwin])
+                    continue
+
+                cc_in = aud_windows(mfcc[:,i*4:],nwin)
+                cc_out  = self.__S__.forward_aud(cc_in.to(self.device))
+                cc_feat.append(cc_out.float().cpu())
 
         im_feat = torch.cat(im_feat,0)
         cc_feat = torch.cat(cc_feat,0)
 
+        print('Compute time %.3f sec.' % (time.time()-tS))
+
+        return im_feat, cc_feat
+
+    def evaluate_feats_stream(self, opt, videofile, mfcc=None, cc_given=None):
+
+        # Same features as evaluate_feats, but frames stay uint8 and only the
+        # current batch of windows is converted to float. Audio is read through
+        # a memory-mapped WAV, so peak memory is O(batch_size).
+
+        self.__S__.eval();
+
         # ========== ==========
-        # Compute offset
+        # Extract audio
         # ========== ==========
-            
+
+        if mfcc is None:
+
+            os.makedirs(os.path.join(opt.tmp_dir,opt.reference), exist_ok=True)
+            audiofile = os.path.join(opt.tmp_dir,opt.reference,'audio.wav')
+
+            command = ("ffmpeg -loglevel error -y -i %s -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 %s" % (videofile,audiofile))
+            output = subprocess.call(command, shell=True, stdout=None)
+
+            if output != 0:
+                raise RuntimeError('ffmpeg failed to extract audio from %s' % videofile)
+
+            sample_rate, audio = wavfile.read(audiofile, mmap=True)
+            num_samples = len(audio)
+
+        else:
+
+            audiofile = None
+            num_samples = mfcc.shape[1]*160
+
+        # ========== ==========
+        # Generate video and audio feats
+        # ========== ==========
+
+        # Window v is scored only once frame v+5 has arrived (lastframe = min_length-5
+        # in evaluate_feats), so 5 frames are carried over between chunks
+        carry       = 5
+        max_windows = math.floor(num_samples/640)-5
+
+        im_feat = []
+        cc_feat = []
+        tail    = None
+        first   = 0
+        nframes = 0
+
+        tS = time.time()
+        with self.inference_context():
+            for chunk in stream_frames(videofile, opt.batch_size):
+
+                nframes += len(chunk)
+                frames  = chunk if tail is None else numpy.concatenate((tail,chunk))
+                nwin    = min(len(frames)-carry, max_windows-first)
+
+                if nwin > 0:
+                    im_in = lip_clip(frames,nwin)
+                    im_out  = self.__S__.forward_lip_sequence(im_in.to(self.device));
+                    im_feat.append(im_out.float().cpu())
+
+                    if cc_given is not None:
+                        cc_feat.append(cc_given[first:first+nwin])
+                    else:
+                        cc_mfcc = mfcc[:,first*4:] if mfcc is not None else self.mfcc_frames(audio,first*4,nwin*4+16)
+                        cc_in = aud_windows(cc_mfcc,nwin)
+                        cc_out  = self.__S__.forward_aud(cc_in.to(self.device))
+                        cc_feat.append(cc_out.float().cpu())
+
+                    first += nwin
+
+                tail = frames[-carry:]
+
+        if (float(num_samples)/16000) != (float(nframes)/25) :
+            print("WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."%(float(num_samples)/16000,float(nframes)/25))
+
+        if audiofile is not None:
+            del audio
+            os.remove(audiofile)
+
+        im_feat = torch.cat(im_feat,0)
+        cc_feat = torch.cat(cc_feat,0)
+
         print('Compute time %.3f sec.' % (time.time()-tS))
 
-        dists = calc_pdist(im_feat,cc_feat,vshift=opt.vshift)
-        mdist = torch.mean(torch.stack(dists,1),1)
+        return im_feat, cc_feat
 
-        minval, minidx = torch.min(mdist,0)
+    def evaluate_feats_many(self, opt, videofiles, inputs):
 
-        offset = opt.vshift-minidx
-        conf   = torch.median(mdist) - minval
+        # evaluate_feats for several crops, with the frames of all crops run back to
+        # back. Each forward_lip_sequence call takes a clip of batch_size windows
+        # wherever the crop boundaries fall, and the windows straddling two crops
+        # are dropped, so short tracks no longer cost a partially filled batch each.
+        # Audio windows are batched across crops the same way. With --stream,
+        # crops without given audio go through evaluate_feats_stream one by one.
 
-        fdist   = numpy.stack([dist[minidx].numpy() for dist in dists])
-        # fdist   = numpy.pad(fdist, (3,3), 'constant', constant_values=15)
-        fconf   = torch.median(mdist).numpy() - fdist
-        fconfm  = signal.medfilt(fconf,kernel_size=9)
-        
-        numpy.set_printoptions(formatter={'float': '{: 0.3f}'.format})
-        print('Framewise conf: ')
-        print(fconfm)
-        print('AV offset: \t%d \nMin dist: \t%.3f\nConfidence: \t%.3f' % (offset,minval,conf))
+        self.__S__.eval();
+
+        bs = opt.batch_size
+
+        im_feat = [ [] for _ in videofiles ]
+        cc_feat = [ None ]*len(videofiles)
+        audio   = [] # (crop, mfcc) of the crops whose audio embeddings are computed here
+
+        # Frames not yet run, with the crop and the frame index in the crop of each.
+        # Window j is scored only once frame j+5 of the same crop is in the buffer,
+        # as lastframe = min_length-5 in evaluate_feats.
+        max_windows = []
+        buf   = None
+        owner = numpy.zeros(0, dtype=int)
+        local = numpy.zeros(0, dtype=int)
+
+        def run_clips(final):
+
+            nonlocal buf, owner, local
+
+            while buf is not None and (len(buf) >= bs+5 or (final and len(buf) >= 6)):
+
+                nwin   = min(bs, len(buf)-5)
+                im_in  = lip_clip(buf,nwin)
+                im_out = self.__S__.forward_lip_sequence(im_in.to(self.device)).float().cpu()
+
+                crop   = owner[:nwin]
+                valid  = (owner[5:nwin+5] == crop) & (local[:nwin] < numpy.array(max_windows)[crop])
+
+                for idx in numpy.unique(crop[valid]):
+                    im_feat[idx].append(im_out[torch.from_numpy(numpy.nonzero(valid & (crop == idx))[0])])
+
+                buf, owner, local = buf[nwin:], owner[nwin:], local[nwin:]
+
+        tS = time.time()
+        with self.inference_context():
+            for idx, videofile in enumerate(videofiles):
+
+                mfcc     = inputs[idx].get('mfcc')
+                cc_given = inputs[idx].get('cc_feat')
+
+                if mfcc is None and getattr(opt,'stream',False):
+                    max_windows.append(0)
+                    im, cc_feat[idx] = self.evaluate_feats_stream(opt, videofile)
+                    im_feat[idx].append(im)
+                    continue
 
-        dists_npy = numpy.array([ dist.numpy() for dist in dists ])
-        return offset.numpy(), conf.numpy(), dists_npy
+                if mfcc is None:
+                    images, wav = load_av(videofile)
+                    mfcc        = self.mfcc_frames(wav)
+                    num_samples = len(wav)
+                    chunks      = ( images[i:i+bs] for i in range(0,len(images),bs) )
+                else:
+                    num_samples = mfcc.shape[1]*160
+                    chunks      = stream_frames(videofile, bs)
+
+                max_windows.append(math.floor(num_samples/640)-5)
+
+                if cc_given is not None:
+                    cc_feat[idx] = cc_given
+                else:
+                    audio.append((idx, mfcc))
+
+                nframes = 0
+                for chunk in chunks:
+                    buf     = chunk if buf is None else numpy.concatenate((buf,chunk))
+                    owner   = numpy.concatenate((owner, numpy.full(len(chunk), idx)))
+                    local   = numpy.concatenate((local, numpy.arange(nframes, nframes+len(chunk))))
+                    nframes += len(chunk)
+                    run_clips(False)
+
+                if (float(num_samples)/16000) != (float(nframes)/25) :
+                    print("WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."%(float(num_samples)/16000,float(nframes)/25))
+
+            run_clips(True)
+
+            im_feat = [ torch.cat(feat,0) for feat in im_feat ]
+
+            # Audio windows of all crops, in batches of batch_size
+            if audio:
+                cc_in  = torch.cat([ aud_windows(mfcc, len(im_feat[idx])) for idx, mfcc in audio ],0)
+                cc_out = torch.cat([ self.__S__.forward_aud(cc_in[i:i+bs].to(self.device)).float().cpu() for i in range(0,len(cc_in),bs) ],0)
+
+                for (idx, mfcc), cc in zip(audio, torch.split(cc_out, [ len(im_feat[idx]) for idx, mfcc in audio ])):
+                    cc_feat[idx] = cc
+
+        print('Compute time %.3f sec. for %d crops' % (time.time()-tS, len(videofiles)))
+
+        return [ (im, cc[:len(im)]) for im, cc in zip(im_feat, cc_feat) ]
 
     def extract_feature(self, opt, videofile):
 
         self.__S__.eval();
+
+        if getattr(opt,'stream',False):
+            return self.extract_feature_stream(opt, videofile)
         
         # ========== ==========
         # Load video 
@@ -166,11 +799,7 @@ class SyncNetInstance(torch.nn.Module):
 
             images.append(image)
 
-        im = numpy.stack(images,axis=3)
-        im = numpy.expand_dims(im,axis=0)
-        im = numpy.transpose(im,(0,3,4,1,2))
-
-        imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
+        images = numpy.stack(images,axis=0)
         
         # ========== ==========
         # Generate video feats
@@ -180,12 +809,12 @@ class SyncNetInstance(torch.nn.Module):
         im_feat = []
 
         tS = time.time()
-        for i in range(0,lastframe,opt.batch_size):
-            
-            im_batch = [ imtv[:,:,vframe:vframe+5,:,:] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            im_in = torch.cat(im_batch,0)
-            im_out  = self.__S__.forward_lipfeat(im_in.cuda());
-            im_feat.append(im_out.data.cpu())
+        with self.inference_context():
+            for i in range(0,lastframe,opt.batch_size):
+
+                im_in = lip_clip(images[i:],min(lastframe,i+opt.batch_size)-i)
+                im_out  = self.__S__.forward_lipfeat_sequence(im_in.to(self.device));
+                im_feat.append(im_out.float().cpu())
 
         im_feat = torch.cat(im_feat,0)
 
@@ -197,8 +826,45 @@ class SyncNetInstance(torch.nn.Module):
 
         return im_feat
 
+    def extract_feature_stream(self, opt, videofile):
+
+        # uint8 frames streamed from ffmpeg, 4 frames carried over between chunks
+
+        carry   = 4
+        im_feat = []
+        tail    = None
+
+        tS = time.time()
+        with self.inference_context():
+            for chunk in stream_frames(videofile, opt.batch_size):
+
+                frames = chunk if tail is None else numpy.concatenate((tail,chunk))
+                nwin   = len(frames)-carry
+
+                if nwin > 0:
+                    im_in = lip_clip(frames,nwin)
+                    im_out  = self.__S__.forward_lipfeat_sequence(im_in.to(self.device));
+                    im_feat.append(im_out.float().cpu())
+
+                tail = frames[-carry:]
+
+        im_feat = torch.cat(im_feat,0)
+
+        print('Compute time %.3f sec.' % (time.time()-tS))
+
+        return im_feat
+
 
     def loadParameters(self, path):
+
+        # With the onnx backend, path is the directory written by export_onnx.py,
+        # or the model file it was exported from
+
+        if self.backend == 'onnx':
+            self.__S__ = OnnxS(path if os.path.isdir(path) else onnx_dir(path), device=self.device, num_threads=self.num_threads)
+            self.model_hash = self.__S__.graph_hash()
+            return
+
         loaded_state = torch.load(path, map_location=lambda storage, loc: storage);
 
         self_state = self.__S__.state_dict();
@@ -206,3 +872,8 @@ class SyncNetInstance(torch.nn.Module):
         for name, param in loaded_state.items():
 
             self_state[name].copy_(param);
+
+        self.model_hash = model_hash(self_state)
+
+        if self.precision == 'int8':
+            self.__S__ = quantize_dynamic(self.__S__)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import sys, math
+import numpy
+import torch
+
+# ==================== MFCC FRONTEND ====================
+
+def hz2mel(hz):
+
+    return 2595*numpy.log10(1+hz/700.)
+
+def mel2hz(mel):
+
+    return 700*(10**(mel/2595.0)-1)
+
+def mel_filterbank(nfilt=26, nfft=512, sample_rate=16000):
+
+    # [nfilt x nfft/2+1] triangular filters, the bins rounded down exactly as
+    # python_speech_features.get_filterbanks does
+
+    melpoints = numpy.linspace(hz2mel(0),hz2mel(sample_rate/2),nfilt+2)
+    bins      = numpy.floor((nfft+1)*mel2hz(melpoints)/sample_rate)
+
+    fbank = numpy.zeros([nfilt,nfft//2+1])
+    for j in range(0,nfilt):
+        for i in range(int(bins[j]), int(bins[j+1])):
+            fbank[j,i] = (i - bins[j]) / (bins[j+1]-bins[j])
+        for i in range(int(bins[j+1]), int(bins[j+2])):
+            fbank[j,i] = (bins[j+2]-i) / (bins[j+2]-bins[j+1])
+
+    return fbank
+
+class MFCC(torch.nn.Module):
+
+    # python_speech_features.mfcc with its default parameters (400 sample frames
+    # every 160 samples without windowing, 512 point FFT, 26 mel filters, 13
+    # cepstra, lifter 22, log frame energy as the first coefficient) in torch, so
+    # it runs on the inference device and on several signals at once. Computed in
+    # float64 like the numpy original.
+
+    def __init__(self, sample_rate=16000, winlen=400, winstep=160, nfft=512, nfilt=26, numcep=13, ceplifter=22, preemph=0.97):
+        super(MFCC, self).__init__();
+
+        self.winlen  = winlen
+        self.winstep = winstep
+        self.nfft    = nfft
+        self.preemph = preemph
+
+        # Orthonormal DCT-II, first numcep rows, with the lifter folded in
+        n   = numpy.arange(nfilt)
+        dct = numpy.cos(numpy.pi*numpy.arange(numcep)[:,None]*(2*n[None,:]+1)/(2*nfilt))*numpy.sqrt(2.0/nfilt)
+        dct[0] /= numpy.sqrt(2)
+
+        lift = 1 + (ceplifter/2.)*numpy.sin(numpy.pi*numpy.arange(numcep)/ceplifter)
+
+        self.register_buffer('fbank', torch.from_numpy(mel_filterbank(nfilt,nfft,sample_rate)))
+        self.register_buffer('dct', torch.from_numpy(dct*lift[:,None]))
+
+    def num_frames(self, num_samples):
+
+        if num_samples <= self.winlen:
+            return 1
+
+        return 1 + int(math.ceil((num_samples-self.winlen)/self.winstep))
+
+    def forward(self, signal, lengths=None, prev=None):
+
+        # signal [B x N] (or [N]) samples -> [B x numcep x F] MFCC frames. Signals
+        # shorter than N give their lengths[b], and their frames from
+        # num_frames(lengths[b]) on are padding. prev [B] is the sample before each
+        # signal, for pre-emphasis of a segment cut out of a longer signal.
+
+        signal = signal.to(self.fbank.dtype)
+        if signal.dim() == 1:
+            signal = signal.unsqueeze(0)
+
+        B, N = signal.shape
+
+        if prev is None:
+            prev = torch.zeros_like(signal[:,:1])
+        else:
+            prev = torch.as_tensor(prev).to(signal).view(B,1)
+
+        emph = signal - self.preemph*torch.cat((prev,signal[:,:-1]),1)
+        if lengths is not None:
+            lengths = torch.as_tensor(lengths, device=signal.device).view(B,1)
+            emph    = emph*(torch.arange(N, device=signal.device)[None,:] < lengths)
+
+        nframes = self.num_frames(N)
+        emph    = torch.nn.functional.pad(emph,(0,(nframes-1)*self.winstep+self.winlen-N))
+        frames  = emph.unfold(1,self.winlen,self.winstep)
+
+        pspec  = torch.fft.rfft(frames,n=self.nfft).abs().square()/self.nfft
+        eps    = numpy.finfo(float).eps
+
+        energy = pspec.sum(2)
+        energy = torch.where(energy == 0, torch.full_like(energy,eps), energy)
+
+        feat = torch.matmul(pspec,self.fbank.t())
+        feat = torch.where(feat == 0, torch.full_like(feat,eps), feat)
+
+        feat = torch.matmul(torch.log(feat),self.dct.t())
+        feat[:,:,0] = torch.log(energy)
+
+        return feat.transpose(1,2)
+
+# ==================== PARITY CHECK ====================
+
+if __name__ == '__main__':
+
+    # python SyncNetMFCC.py [file.wav ...]: compares against python_speech_features
+    # on random signals and on the given 16 kHz WAV files
+
+    import python_speech_features
+    from scipy.io import wavfile
+
+    signals = [ numpy.random.RandomState(ii).randint(-32768,32767,size=n).astype(numpy.int16) for ii, n in enumerate([100,400,401,16000,16123]) ]
+    signals.append(numpy.zeros(8000, dtype=numpy.int16))
+
+    for fname in sys.argv[1:]:
+        signals.append(wavfile.read(fname)[1])
+
+    frontend = MFCC()
+    failed   = 0
+
+    for signal in signals:
+        ref  = python_speech_features.mfcc(signal,16000).T
+        out  = frontend(torch.from_numpy(signal.astype(numpy.int64))).numpy()[0]
+        diff = numpy.abs(ref-out).max()
+        print('%7d samples: max abs diff %.3g' % (len(signal),diff))
+        failed += not diff < 1e-6
+
+    # Batched, with padding, and a segment continued from the sample before it
+    batch = torch.zeros(2,16123)
+    batch[0,:16000] = torch.from_numpy(signals[3].astype(numpy.float32))
+    batch[1]        = torch.from_numpy(signals[4].astype(numpy.float32))
+    out   = frontend(batch, lengths=[16000,16123]).numpy()
+
+    seg   = frontend(torch.from_numpy(signals[4][1600:].astype(numpy.int64)), prev=[float(signals[4][1599])]).numpy()[0]
+
+    for name, a, b in [('batch', out[0][:,:frontend.num_frames(16000)], python_speech_features.mfcc(signals[3],16000).T),
+                       ('batch', out[1], python_speech_features.mfcc(signals[4],16000).T),
+                       ('segment', seg, python_speech_features.mfcc(signals[4],16000).T[:,10:])]:
+        diff = numpy.abs(a-b).max()
+        print('%7s: max abs diff %.3g' % (name,diff))
+        failed += not diff < 1e-6
+
+    sys.exit(1 if failed else 0)
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 #-*- coding: utf-8 -*-
 
+import sys
 import torch
 import torch.nn as nn
 
@@ -114,4 +115,56 @@ class S(nn.Module):
         mid = self.netcnnlip(x);
         out = mid.view((mid.size()[0], -1)); # N x (ch x 24)
 
-        return out;
\ No newline at end of file
+        return out;
+
+    # Only the first Conv3d of netcnnlip has a temporal kernel (5), every later
+    # layer has temporal extent 1. Running it once over a N x 3 x T x H x W clip
+    # therefore gives the features of all T-4 sliding 5-frame windows while each
+    # frame's spatial stack is computed once instead of five times.
+
+    def forward_lip_sequence(self, x):
+
+        out = self.forward_lipfeat_sequence(x); # (N x T-4) x ch
+        out = self.netfclip(out);
+
+        return out;
+
+    def forward_lipfeat_sequence(self, x):
+
+        mid = self.netcnnlip(x); # N x ch x T-4 x 1 x 1
+        out = mid.transpose(1, 2).reshape((-1, mid.size()[1])); # (N x T-4) x ch
+
+        return out;
+
+# ==================== PARITY CHECK ====================
+
+if __name__ == '__main__':
+
+    # python SyncNetModel.py [syncnet_v2.model]: compares forward_lip_sequence and
+    # forward_lipfeat_sequence against forward_lip and forward_lipfeat on the
+    # 5-frame windows of the same clips, with random weights or the given model
+
+    torch.manual_seed(0)
+
+    model = S(num_layers_in_fc_layers = 1024);
+    if len(sys.argv) > 1:
+        model.load_state_dict(torch.load(sys.argv[1], map_location='cpu'));
+    model.eval();
+
+    failed = 0
+
+    with torch.no_grad():
+        for N, T in [(1,5), (1,24), (3,12)]:
+
+            clip    = torch.randint(0,256,(N,3,T,224,224)).float()
+            windows = clip.unfold(2,5,1).permute(0,2,1,5,3,4).reshape(-1,3,5,224,224) # (N x T-4) x 3 x 5 x H x W
+
+            for name, seq, win in [('lip', model.forward_lip_sequence, model.forward_lip),
+                                   ('lipfeat', model.forward_lipfeat_sequence, model.forward_lipfeat)]:
+                out  = seq(clip)
+                ref  = win(windows)
+                diff = (out-ref).abs().max().item()/max(ref.abs().max().item(),1e-6)
+                print('%-8s %d x %2d frames: max relative diff %.3g' % (name,N,T,diff))
+                failed += not (out.shape == ref.shape and diff < 1e-5)
+
+    sys.exit(1 if failed else 0)
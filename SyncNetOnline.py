@@ -0,0 +1,130 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+# Video 25 FPS, Audio 16000HZ
+
+import torch
+import numpy
+import collections
+
+from SyncNetInstance import *
+
+# ==================== ONLINE ESTIMATOR ====================
+
+class SyncNetOnline(object):
+
+    # Incremental AV offset estimate for live input. Frames (uint8 BGR face crops)
+    # and mono int16 PCM are pushed as they arrive; lip and audio embeddings are
+    # computed once per 5-frame window and kept in ring buffers, and every `hop`
+    # seconds the offset and confidence over the last `window` seconds are
+    # recomputed from those buffers only.
+    #
+    # An estimate covering lip windows up to frame T needs audio up to T+vshift,
+    # so results trail the input by a fixed vshift+4 frames (plus batch_size
+    # frames of batching).
+
+    def __init__(self, syncnet, vshift=15, window=5.0, hop=1.0, batch_size=5, frame_rate=25):
+
+        self.syncnet    = syncnet
+        self.vshift     = vshift
+        self.batch_size = batch_size
+        self.frame_rate = frame_rate
+
+        self.win_frames = int(round(window*frame_rate))
+        self.hop_frames = max(int(round(hop*frame_rate)),1)
+
+        # Lip embeddings are only used once vshift later windows have audio
+        self.lip_feat = collections.deque(maxlen=self.win_frames+vshift)
+        self.aud_feat = collections.deque(maxlen=self.win_frames+2*vshift)
+
+        self.frames    = None   # pending frames, frames[0] is window self.nwin
+        self.audio     = numpy.zeros(0, dtype=numpy.int16)
+        self.audio_pos = 0      # absolute sample index of self.audio[0]
+
+        self.nwin      = 0      # windows embedded so far
+        self.last_emit = 0
+
+        self.syncnet.__S__.eval();
+
+    def push(self, frames=None, audio=None):
+
+        # Returns the list of estimates that became available with this input
+
+        if frames is not None and len(frames) > 0:
+            frames = numpy.asarray(frames, dtype=numpy.uint8)
+            self.frames = frames if self.frames is None else numpy.concatenate((self.frames,frames))
+
+        if audio is not None and len(audio) > 0:
+            self.audio = numpy.concatenate((self.audio,numpy.asarray(audio, dtype=numpy.int16)))
+
+        results = []
+
+        while True:
+            nwin = min(self.ready_windows(), self.batch_size)
+            if nwin <= 0:
+                break
+
+            self.embed(nwin)
+
+            ready = self.nwin - self.vshift
+            if ready > 0 and ready - self.last_emit >= self.hop_frames:
+                results.append(self.estimate())
+                self.last_emit = ready
+
+        return results
+
+    def ready_windows(self):
+
+        # Windows whose 5 frames and 20 MFCC frames (640v+3440 samples) have both arrived
+        nvid = 0 if self.frames is None else len(self.frames)-4
+        naud = (self.audio_pos+len(self.audio)-3440)//640 + 1 - self.nwin
+
+        return min(nvid, naud)
+
+    def embed(self, nwin):
+
+        # Keep one window of samples before the first MFCC frame for pre-emphasis
+        start = 4 if self.nwin > 0 else 0
+        first = self.nwin*640 - self.audio_pos
+
+        mfcc  = self.syncnet.mfcc_frames(self.audio[first-start*160:], start, nwin*4+16)
+
+        with self.syncnet.inference_context():
+            im_out = self.syncnet.__S__.forward_lip_sequence(lip_clip(self.frames,nwin).to(self.syncnet.device))
+            cc_out = self.syncnet.__S__.forward_aud(aud_windows(mfcc,nwin).to(self.syncnet.device))
+
+        self.lip_feat.extend(im_out.float().cpu())
+        self.aud_feat.extend(cc_out.float().cpu())
+
+        self.nwin  += nwin
+        self.frames = self.frames[nwin:]
+
+        # Drop samples no longer needed, keeping one window of history
+        drop = max(self.nwin-1,0)*640 - self.audio_pos
+        if drop > 0:
+            self.audio      = self.audio[drop:]
+            self.audio_pos += drop
+
+    def estimate(self):
+
+        # Lip windows [T-m, T) against audio windows [T-m-vshift, T+vshift), zero
+        # padded before the start of the stream as in calc_pdist
+
+        ready = self.nwin - self.vshift
+        m     = min(self.win_frames, ready)
+
+        nlip    = len(self.lip_feat)
+        im_feat = torch.stack(list(self.lip_feat)[nlip-self.vshift-m:nlip-self.vshift])
+        cc_feat = torch.stack(list(self.aud_feat)[-min(len(self.aud_feat),m+2*self.vshift):])
+        cc_feat = torch.nn.functional.pad(cc_feat,(0,0,m+2*self.vshift-len(cc_feat),0))
+
+        dists = calc_pdist_padded(im_feat, cc_feat, vshift=self.vshift)
+        mdist = torch.mean(dists,0)
+
+        minval, minidx = torch.min(mdist,0)
+
+        return {'frame':    ready,
+                'time':     float(ready)/self.frame_rate,
+                'frames':   m,
+                'offset':   int(self.vshift-minidx),
+                'min_dist': float(minval),
+                'conf':     float(torch.median(mdist)-minval)}
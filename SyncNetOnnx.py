@@ -0,0 +1,108 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, hashlib, inspect
+import torch
+
+from detectors.s3fd.onnx_utils import onnx_session
+
+# ==================== ONNX GRAPHS ====================
+
+# SyncNet is exported as one graph per forward method SyncNetInstance uses. lip
+# and lipfeat take a [N x 3 x T x H x W] clip as S.forward_lip_sequence does and
+# return one row per 5-frame window; aud takes [N x 1 x 13 x 20] MFCC windows.
+
+GRAPHS = {
+    'lip':     ('forward_lip_sequence',     'video', {0:'batch', 2:'time', 3:'height', 4:'width'}),
+    'lipfeat': ('forward_lipfeat_sequence', 'video', {0:'batch', 2:'time', 3:'height', 4:'width'}),
+    'aud':     ('forward_aud',              'mfcc',  {0:'batch'}),
+}
+
+def onnx_dir(model_path):
+
+    # Where export_onnx.py writes the graphs of a SyncNet model file
+    return os.path.splitext(model_path)[0]+'_onnx'
+
+class Forward(torch.nn.Module):
+
+    # A forward_* method of a model as the forward of a module, for torch.onnx.export
+
+    def __init__(self, model, method):
+        super(Forward, self).__init__();
+
+        self.model  = model
+        self.method = method
+
+    def forward(self, *args):
+
+        return getattr(self.model, self.method)(*args)
+
+def export_graph(module, args, path, input_names, output_names, dynamic_axes, opset=17):
+
+    # TorchScript based export. Constant folding is left to ONNX Runtime: the
+    # exporter's own Conv+BatchNorm folding is wrong for untrained BatchNorm
+    # layers whose parameters it deduplicates.
+
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    torch.onnx.export(module.eval(), args, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=False, **kwargs)
+
+def export_syncnet(model, out_dir, opset=17):
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    inputs = {'video': torch.zeros(1,3,9,224,224), 'mfcc': torch.zeros(2,1,13,20)}
+
+    for name, (method, input_name, axes) in GRAPHS.items():
+        export_graph(Forward(model,method), (inputs[input_name],), os.path.join(out_dir,name+'.onnx'),
+                     [input_name], ['output'], {input_name:axes, 'output':{0:'batch'}}, opset)
+
+# ==================== ONNX RUNTIME ====================
+
+# Sessions are built by detectors.s3fd.onnx_utils.onnx_session, shared with S3FD
+
+def run_session(session, x):
+
+    # torch tensor in, torch tensor out on the same device
+    out = session.run(None, {session.get_inputs()[0].name: x.detach().cpu().numpy()})[0]
+
+    return torch.from_numpy(out).to(x.device)
+
+class OnnxS(torch.nn.Module):
+
+    # Stands in for SyncNetModel.S in SyncNetInstance, with the forward methods
+    # it calls run by ONNX Runtime from the graphs in onnx_dir
+
+    def __init__(self, onnx_dir, device='cpu', num_threads=0):
+        super(OnnxS, self).__init__();
+
+        self.sessions = {}
+        self.hash     = hashlib.sha1()
+
+        for name in sorted(GRAPHS):
+            path = os.path.join(onnx_dir,name+'.onnx')
+
+            if not os.path.exists(path):
+                raise FileNotFoundError('%s not found, run export_onnx.py first' % path)
+
+            with open(path, 'rb') as fil:
+                self.hash.update(fil.read())
+
+            self.sessions[name] = onnx_session(path, device, num_threads)
+
+    def graph_hash(self):
+
+        return self.hash.hexdigest()
+
+    def forward_lip_sequence(self, x):
+
+        return run_session(self.sessions['lip'], x)
+
+    def forward_lipfeat_sequence(self, x):
+
+        return run_session(self.sessions['lipfeat'], x)
+
+    def forward_aud(self, x):
+
+        return run_session(self.sessions['aud'], x)
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os, copy, pickle, time
+
+import run_pipeline
+import run_syncnet
+
+from detectors import S3FD
+from SyncNetInstance import SyncNetInstance
+
+# ==================== OPTIONS ====================
+
+def parse_runner_options(argv):
+
+    # Options of run_pipeline.py and run_syncnet.py merged into one namespace,
+    # defaults for anything argv does not set. Options both scripts share
+    # (data_dir, device, ...) are parsed once. Returns the unparsed arguments too.
+
+    opt, rest = run_pipeline.parser.parse_known_args(argv)
+    sopt, rest = run_syncnet.parser.parse_known_args(rest)
+
+    for key, value in vars(sopt).items():
+        if not hasattr(opt, key):
+            setattr(opt, key, value)
+
+    return opt, rest
+
+def runner_options(argv=[]):
+
+    opt, rest = parse_runner_options(argv)
+
+    if rest:
+        raise ValueError('Unknown options: %s'%' '.join(rest))
+
+    return opt
+
+# ==================== RUNNER ====================
+
+class SyncNetRunner(object):
+
+    # Face tracking and SyncNet scoring for many videos in one process. S3FD and
+    # SyncNet are loaded once in the constructor and reused for every call to
+    # run(), which produces the same files as run_pipeline.py followed by
+    # run_syncnet.py.
+
+    def __init__(self, opt=None, **kwargs):
+
+        self.opt = runner_options() if opt is None else copy.copy(opt)
+
+        for key, value in kwargs.items():
+            setattr(self.opt, key, value)
+
+        start_time = time.time()
+
+        self.DET = S3FD(device=self.opt.device, num_threads=self.opt.num_threads, backend=self.opt.backend)
+
+        self.syncnet = SyncNetInstance(device=self.opt.device, num_threads=self.opt.num_threads, precision=self.opt.precision, backend=self.opt.backend)
+        self.syncnet.loadParameters(self.opt.initial_model)
+
+        print('Models loaded (%.2f sec)'%(time.time()-start_time))
+
+    def run(self, videofile, reference=None, **kwargs):
+
+        # Returns one {'track', 'offset', 'conf'} dict per face track; the track
+        # is the crop_video record saved in tracks.pckl
+
+        opt = copy.copy(self.opt)
+
+        opt.videofile = videofile
+        opt.reference = reference if reference is not None else os.path.splitext(os.path.basename(videofile))[0]
+
+        for key, value in kwargs.items():
+            setattr(opt, key, value)
+
+        run_pipeline.set_dirs(opt)
+        run_pipeline.pipeline(opt, DET=self.DET)
+
+        offsets, confs, dists = run_syncnet.evaluate_crops(opt, self.syncnet)
+
+        with open(os.path.join(opt.work_dir,opt.reference,'tracks.pckl'), 'rb') as fil:
+            tracks = pickle.load(fil)
+
+        return [ {'track':track, 'offset':int(offset), 'conf':float(conf)} for track, offset, conf in zip(tracks, offsets, confs) ]
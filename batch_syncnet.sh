@@ -1,20 +1,22 @@
 #!/bin/bash
 # SyncNet 批量处理脚本
-# 用法: ./batch_syncnet.sh [--skip-failed] [--skip-video-failed]
+# 用法: ./batch_syncnet.sh [--skip-failed] [--skip-video-failed] [--workers N]
 
 # ==================== 配置 ====================
-PYTHON_SCRIPT="./batch_syncnet.py"  # 您的Python批量脚本
+PYTHON_SCRIPT="./multi_run_automation.py"  # Python批量脚本
 DATA_ROOT="./data/work"             # 输出数据根目录
 LOG_DIR="./batch_logs"              # 批量日志目录
 
 # ==================== 参数解析 ====================
 SKIP_FAILED=""
 SKIP_VIDEO_FAILED=""
+WORKERS=1                           # 每个任务目录内同时处理的视频数
 
 while [[ "$#" -gt 0 ]]; do
     case $1 in
         --skip-failed) SKIP_FAILED="--skip-failed" ;;
         --skip-video-failed) SKIP_VIDEO_FAILED="--skip-video-failed" ;;
+        --workers) WORKERS="$2"; shift ;;
         *) echo "未知参数: $1" && exit 1 ;;
     esac
     shift
@@ -46,7 +48,7 @@ echo "开始时间: $(date)"
 echo "Python脚本: $PYTHON_SCRIPT"
 echo "数据根目录: $DATA_ROOT"
 echo "总任务数: ${#tasks[@]}"
-echo "参数: $SKIP_FAILED $SKIP_VIDEO_FAILED"
+echo "参数: $SKIP_FAILED $SKIP_VIDEO_FAILED --workers $WORKERS"
 echo "========================================"
 
 # 创建日志目录
@@ -61,7 +63,7 @@ echo "执行时间: $(date)"
 echo "Python脚本: $PYTHON_SCRIPT"
 echo "数据根目录: $DATA_ROOT"
 echo "总任务数: ${#tasks[@]}"
-echo "参数: $SKIP_FAILED $SKIP_VIDEO_FAILED"
+echo "参数: $SKIP_FAILED $SKIP_VIDEO_FAILED --workers $WORKERS"
 echo "==================================="
 echo ""
 } | tee -a "$batch_log_file"
@@ -102,6 +104,7 @@ for i in "${!tasks[@]}"; do
     PYTHON_CMD="python3 \"$PYTHON_SCRIPT\" \
         --input_dir \"$input_dir\" \
         --data_dir \"$output_dir\" \
+        --workers $WORKERS \
         $SKIP_FAILED \
         $SKIP_VIDEO_FAILED"
     
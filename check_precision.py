@@ -0,0 +1,104 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+# Compares reduced precision SyncNet inference against fp32 on a set of clips:
+# offset agreement, confidence deltas and compute time per precision.
+#
+#   python check_precision.py --data_dir /path/to/output --reference a b --device cpu
+#   python check_precision.py data/example.avi --precision int8
+#
+# Positional clips are face videos with their own audio; --reference scores the
+# face track crops run_pipeline.py wrote under --data_dir.
+
+import sys, time, argparse, glob, os
+import numpy
+
+from SyncNetInstance import *
+
+# ==================== PARSE ARGUMENT ====================
+
+parser = argparse.ArgumentParser(description = "SyncNet precision check");
+parser.add_argument('videofiles', nargs='*', help='Face videos with audio');
+parser.add_argument('--reference', type=str, nargs='*', default=[], help='References whose crops in --data_dir are checked');
+parser.add_argument('--data_dir', type=str, default='data/work', help='');
+parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
+parser.add_argument('--precision', type=str, nargs='+', default=['bf16','int8'], choices=['bf16','int8'], help='Precisions compared against fp32');
+parser.add_argument('--batch_size', type=int, default='20', help='');
+parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--device', type=str, default='cpu', help='cuda, cuda:N or cpu');
+parser.add_argument('--num_threads', type=int, default='0', help='Intra-op CPU threads, 0 keeps the torch default');
+parser.add_argument('--min_agreement', type=float, default=0.95, help='Fail if fewer clips than this fraction get the fp32 offset');
+parser.add_argument('--max_conf_delta', type=float, default=1.0, help='Fail if the mean absolute confidence delta is larger');
+opt = parser.parse_args();
+
+setattr(opt,'avi_dir',os.path.join(opt.data_dir,'pyavi'))
+setattr(opt,'tmp_dir',os.path.join(opt.data_dir,'pytmp'))
+setattr(opt,'work_dir',os.path.join(opt.data_dir,'pywork'))
+setattr(opt,'crop_dir',os.path.join(opt.data_dir,'pycrop'))
+
+# ==================== CLIPS ====================
+
+# (reference, videofile, index in the reference's crops or None)
+clips = [ ('check', fname, None) for fname in opt.videofiles ]
+
+for reference in opt.reference:
+    flist = sorted(glob.glob(os.path.join(opt.crop_dir,reference,'0*.avi')))
+    clips.extend([ (reference, fname, idx) for idx, fname in enumerate(flist) ])
+
+if not clips:
+    parser.error('no clips given')
+
+# ==================== EVALUATE ====================
+
+def evaluate_all(precision):
+
+    s = SyncNetInstance(device=opt.device, num_threads=opt.num_threads, precision=precision);
+    s.loadParameters(opt.initial_model);
+
+    audio   = {}
+    results = []
+
+    tS = time.time()
+    for reference, fname, idx in clips:
+
+        opt.reference = reference
+
+        if idx is None:
+            kwargs = {}
+        else:
+            if reference not in audio:
+                audio[reference] = s.track_audio(opt, len([ c for c in clips if c[0] == reference ]))
+            kwargs = audio[reference][idx]
+
+        offset, conf, dist = s.evaluate(opt, videofile=fname, **kwargs)
+        results.append((int(offset), float(conf)))
+
+    return results, time.time()-tS
+
+reference_results, reference_time = evaluate_all('fp32')
+
+# ==================== REPORT ====================
+
+failed = False
+report = ['%-8s %8s %8s %10s %10s' % ('', 'agree', 'time', 'mean|dc|', 'max|dc|'),
+          '%-8s %8s %7.1fs %10s %10s' % ('fp32', '-', reference_time, '-', '-')]
+
+for precision in opt.precision:
+
+    results, elapsed = evaluate_all(precision)
+
+    agree  = numpy.mean([ a[0] == b[0] for a, b in zip(reference_results, results) ])
+    deltas = numpy.abs([ a[1] - b[1] for a, b in zip(reference_results, results) ])
+
+    report.append('%-8s %7.1f%% %7.1fs %10.3f %10.3f' % (precision, 100*agree, elapsed, deltas.mean(), deltas.max()))
+
+    for (reference, fname, idx), a, b in zip(clips, reference_results, results):
+        if a[0] != b[0]:
+            report.append('    %s: offset %d (fp32 %d), conf %.3f (fp32 %.3f)' % (fname, b[0], a[0], b[1], a[1]))
+
+    if agree < opt.min_agreement or deltas.mean() > opt.max_conf_delta:
+        failed = True
+
+print('\n%d clips\n%s' % (len(clips), '\n'.join(report)))
+
+sys.exit(1 if failed else 0)
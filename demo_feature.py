@@ -13,6 +13,11 @@ parser = argparse.ArgumentParser(description = "SyncNet");
 parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
 parser.add_argument('--batch_size', type=int, default='20', help='');
 parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--device', type=str, default='cuda', help='cuda, cuda:N or cpu');
+parser.add_argument('--num_threads', type=int, default='0', help='Intra-op CPU threads, 0 keeps the torch default');
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32','bf16','int8'], help='SyncNet inference precision: bf16 autocast, or int8 dynamic quantization of the fc layers (cpu only)');
+parser.add_argument('--backend', type=str, default='torch', choices=['torch','onnx'], help='Run SyncNet with torch, or with ONNX Runtime on the graphs written by export_onnx.py');
+parser.add_argument('--stream', action='store_true', help='Stream frames and audio with O(batch_size) memory, for long tracks');
 parser.add_argument('--videofile', type=str, default="data/example.avi", help='');
 parser.add_argument('--tmp_dir', type=str, default="data", help='');
 parser.add_argument('--save_as', type=str, default="data/features.pt", help='');
@@ -22,7 +27,7 @@ opt = parser.parse_args();
 
 # ==================== RUN EVALUATION ====================
 
-s = SyncNetInstance();
+s = SyncNetInstance(device=opt.device, num_threads=opt.num_threads, precision=opt.precision, backend=opt.backend);
 
 s.loadParameters(opt.initial_model);
 print("Model %s loaded."%opt.initial_model);
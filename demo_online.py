@@ -0,0 +1,49 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import argparse
+
+from SyncNetOnline import *
+
+# ==================== LOAD PARAMS ====================
+
+
+parser = argparse.ArgumentParser(description = "SyncNet online");
+
+parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
+parser.add_argument('--batch_size', type=int, default='5', help='');
+parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--device', type=str, default='cuda', help='cuda, cuda:N or cpu');
+parser.add_argument('--num_threads', type=int, default='0', help='Intra-op CPU threads, 0 keeps the torch default');
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32','bf16','int8'], help='SyncNet inference precision: bf16 autocast, or int8 dynamic quantization of the fc layers (cpu only)');
+parser.add_argument('--backend', type=str, default='torch', choices=['torch','onnx'], help='Run SyncNet with torch, or with ONNX Runtime on the graphs written by export_onnx.py');
+parser.add_argument('--window', type=float, default='5.0', help='Seconds of history used for each estimate');
+parser.add_argument('--hop', type=float, default='1.0', help='Seconds between estimates');
+parser.add_argument('--chunk', type=float, default='0.2', help='Seconds of input pushed at a time');
+parser.add_argument('--videofile', type=str, default="data/example.avi", help='Face crop video, file or anything ffmpeg can read');
+
+opt = parser.parse_args();
+
+
+# ==================== RUN ONLINE EVALUATION ====================
+
+s = SyncNetInstance(device=opt.device, num_threads=opt.num_threads, precision=opt.precision, backend=opt.backend);
+
+s.loadParameters(opt.initial_model);
+print("Model %s loaded."%opt.initial_model);
+
+online = SyncNetOnline(s, vshift=opt.vshift, window=opt.window, hop=opt.hop, batch_size=opt.batch_size)
+
+video = stream_frames(opt.videofile, max(int(opt.chunk*25),1))
+audio = stream_audio(opt.videofile, max(int(opt.chunk*16000),1))
+
+def report(results):
+    for result in results:
+        print('%8.2fs \tAV offset: %3d \tMin dist: %.3f \tConfidence: %.3f' % (result['time'],result['offset'],result['min_dist'],result['conf']))
+
+# Interleave the two pipes as a live source would, then flush any trailing audio
+for frames in video:
+    report(online.push(frames=frames, audio=next(audio, None)))
+
+for pcm in audio:
+    report(online.push(audio=pcm))
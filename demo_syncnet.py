@@ -13,6 +13,13 @@ parser = argparse.ArgumentParser(description = "SyncNet");
 parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
 parser.add_argument('--batch_size', type=int, default='20', help='');
 parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--device', type=str, default='cuda', help='cuda, cuda:N or cpu');
+parser.add_argument('--num_threads', type=int, default='0', help='Intra-op CPU threads, 0 keeps the torch default');
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32','bf16','int8'], help='SyncNet inference precision: bf16 autocast, or int8 dynamic quantization of the fc layers (cpu only)');
+parser.add_argument('--backend', type=str, default='torch', choices=['torch','onnx'], help='Run SyncNet with torch, or with ONNX Runtime on the graphs written by export_onnx.py');
+parser.add_argument('--stream', action='store_true', help='Stream frames and audio with O(batch_size) memory, for long tracks');
+parser.add_argument('--cache_dir', type=str, default='', help='Directory for cached embeddings, empty disables the cache');
+parser.add_argument('--cache_size', type=float, default='10', help='Maximum cache size in GB, least recently used entries are evicted');
 parser.add_argument('--videofile', type=str, default="data/example.avi", help='');
 parser.add_argument('--tmp_dir', type=str, default="data/work/pytmp", help='');
 parser.add_argument('--reference', type=str, default="demo", help='');
@@ -22,7 +29,7 @@ opt = parser.parse_args();
 
 # ==================== RUN EVALUATION ====================
 
-s = SyncNetInstance();
+s = SyncNetInstance(device=opt.device, num_threads=opt.num_threads, precision=opt.precision, backend=opt.backend);
 
 s.loadParameters(opt.initial_model);
 print("Model %s loaded."%opt.initial_model);
@@ -3,59 +3,83 @@ import numpy as np
 import cv2
 import torch
 from torchvision import transforms
-from .nets import S3FDNet
+from .nets import S3FDNet, S3FDOnnx
 from .box_utils import nms_
 
 PATH_WEIGHT = './detectors/s3fd/weights/sfd_face.pth'
+PATH_ONNX = './detectors/s3fd/weights/sfd_face.onnx'
 img_mean = np.array([104., 117., 123.])[:, np.newaxis, np.newaxis].astype('float32')
 
 
+def inference_context():
+    # inference_mode (torch>=1.9) also drops version counter bookkeeping; fall back to no_grad
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
 class S3FD():
 
-    def __init__(self, device='cuda'):
+    def __init__(self, device='cuda', num_threads=0, backend='torch'):
 
         tstamp = time.time()
         self.device = device
 
-        print('[S3FD] loading with', self.device)
-        self.net = S3FDNet(device=self.device).to(self.device)
-        state_dict = torch.load(PATH_WEIGHT, map_location=self.device)
-        self.net.load_state_dict(state_dict)
-        self.net.eval()
+        if torch.device(self.device).type == 'cpu' and num_threads > 0:
+            torch.set_num_threads(num_threads)
+
+        print('[S3FD] loading with', self.device, backend)
+        if backend == 'onnx':
+            # Backbone and heads exported by export_onnx.py
+            self.net = S3FDOnnx(PATH_ONNX, device=self.device, num_threads=num_threads)
+        else:
+            self.net = S3FDNet(device=self.device).to(self.device)
+            state_dict = torch.load(PATH_WEIGHT, map_location=self.device)
+            self.net.load_state_dict(state_dict)
+            self.net.eval()
+        self.rgb_mean = torch.from_numpy(img_mean[::-1].copy()).view(1, 3, 1, 1).to(self.device)
         print('[S3FD] finished loading (%.4f sec)' % (time.time() - tstamp))
     
     def detect_faces(self, image, conf_th=0.8, scales=[1]):
 
-        w, h = image.shape[1], image.shape[0]
+        return self.detect_faces_batch([image], conf_th=conf_th, scales=scales)[0]
+
+    def detect_faces_batch(self, images, conf_th=0.8, scales=[1]):
+
+        # images: list of same-sized RGB frames. Every scale runs as a single
+        # forward over the whole list; returns one bboxes array per frame.
+
+        w, h = images[0].shape[1], images[0].shape[0]
 
-        bboxes = np.empty(shape=(0, 5))
+        bboxes = [np.empty(shape=(0, 5)) for _ in images]
 
-        with torch.no_grad():
+        with inference_context():
             for s in scales:
-                scaled_img = cv2.resize(image, dsize=(0, 0), fx=s, fy=s, interpolation=cv2.INTER_LINEAR)
-
-                scaled_img = np.swapaxes(scaled_img, 1, 2)
-                scaled_img = np.swapaxes(scaled_img, 1, 0)
-                scaled_img = scaled_img[[2, 1, 0], :, :]
-                scaled_img = scaled_img.astype('float32')
-                scaled_img -= img_mean
-                scaled_img = scaled_img[[2, 1, 0], :, :]
-                x = torch.from_numpy(scaled_img).unsqueeze(0).to(self.device)
+                scaled = np.stack([cv2.resize(image, dsize=(0, 0), fx=s, fy=s, interpolation=cv2.INTER_LINEAR) for image in images])
+
+                # RGB uint8 N x H x W x 3 -> mean-subtracted float N x 3 x H x W, on the device
+                x = torch.from_numpy(scaled).to(self.device).permute(0, 3, 1, 2).to(torch.float, memory_format=torch.contiguous_format)
+                x -= self.rgb_mean
                 y = self.net(x)
 
                 detections = y.data
-                scale = torch.Tensor([w, h, w, h])
-
-                for i in range(detections.size(1)):
-                    j = 0
-                    while detections[0, i, j, 0] > conf_th:
-                        score = detections[0, i, j, 0]
-                        pt = (detections[0, i, j, 1:] * scale).cpu().numpy()
-                        bbox = (pt[0], pt[1], pt[2], pt[3], score)
-                        bboxes = np.vstack((bboxes, bbox))
-                        j += 1
-
-            keep = nms_(bboxes, 0.1)
-            bboxes = bboxes[keep]
+                scale = torch.tensor([w, h, w, h], dtype=detections.dtype, device=detections.device)
+
+                # Detect output is sorted by score within each class and zero padded,
+                # so thresholding picks the same boxes as walking each class until
+                # the first score <= conf_th. Boxes come out per frame, class, rank.
+                mask = detections[..., 0] > conf_th
+                dets = torch.cat((detections[..., 1:] * scale, detections[..., :1]), dim=-1)[mask]
+                frame_idx = mask.nonzero()[:, 0]
+
+                dets = dets.cpu().numpy().astype(np.float64)
+                counts = np.bincount(frame_idx.cpu().numpy(), minlength=len(images))
+
+                for n, frame_dets in enumerate(np.split(dets, np.cumsum(counts)[:-1])):
+                    bboxes[n] = np.concatenate((bboxes[n], frame_dets))
+
+            for n in range(len(images)):
+                keep = nms_(bboxes[n], 0.1)
+                bboxes[n] = bboxes[n][keep]
 
         return bboxes
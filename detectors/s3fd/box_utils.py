@@ -1,7 +1,7 @@
 import numpy as np
-from itertools import product as product
 import torch
 from torch.autograd import Function
+from torchvision.ops import batched_nms
 
 
 def nms_(dets, thresh):
@@ -35,7 +35,7 @@ def nms_(dets, thresh):
         inds = np.where(ovr <= thresh)[0]
         order = order[inds + 1]
 
-    return np.array(keep).astype(np.int)
+    return np.array(keep).astype(np.int64)
 
 
 def decode(loc, priors, variances):
@@ -151,24 +151,37 @@ class Detect(object):
         decoded_boxes = decode(loc_data.view(-1, 4), batch_priors, self.variance)
         decoded_boxes = decoded_boxes.view(num, num_priors, 4)
 
-        output = torch.zeros(num, self.num_classes, self.top_k, 5)
+        output = loc_data.new_zeros(num, self.num_classes, self.top_k, 5)
 
-        for i in range(num):
-            boxes = decoded_boxes[i].clone()
-            conf_scores = conf_preds[i].clone()
+        # All images of the batch go through one batched_nms call per class: a
+        # pre-NMS top-k and score filter per image, then NMS on boxes tagged with
+        # their image index so boxes of different images never suppress each other
+        k = min(self.nms_top_k, num_priors)
+        img_idx = torch.arange(num, device=loc_data.device).view(-1, 1).expand(num, k)
 
-            for cl in range(1, self.num_classes):
-                c_mask = conf_scores[cl].gt(self.conf_thresh)
-                scores = conf_scores[cl][c_mask]
-                
-                if scores.dim() == 0:
-                    continue
-                l_mask = c_mask.unsqueeze(1).expand_as(boxes)
-                boxes_ = boxes[l_mask].view(-1, 4)
-                ids, count = nms(boxes_, scores, self.nms_thresh, self.nms_top_k)
-                count = count if count < self.top_k else self.top_k
+        for cl in range(1, self.num_classes):
+            top_scores, top_idx = conf_preds[:, cl].topk(k, dim=1)
+            top_boxes = decoded_boxes.gather(1, top_idx.unsqueeze(2).expand(num, k, 4))
 
-                output[i, cl, :count] = torch.cat((scores[ids[:count]].unsqueeze(1), boxes_[ids[:count]]), 1)
+            valid = top_scores.gt(self.conf_thresh)
+            scores = top_scores[valid]
+            boxes = top_boxes[valid]
+            images = img_idx[valid]
+
+            if scores.numel() == 0:
+                continue
+
+            # keep is ordered by decreasing score; regroup it per image, stably
+            keep = batched_nms(boxes, scores, images, self.nms_thresh)
+            keep = keep[(images[keep] * keep.numel() + torch.arange(keep.numel(), device=keep.device)).argsort()]
+
+            # Rank of each kept box within its image, truncated to top_k
+            kept_images = images[keep]
+            counts = torch.bincount(kept_images, minlength=num)
+            rank = torch.arange(keep.numel(), device=keep.device) - (counts.cumsum(0) - counts)[kept_images]
+            sel = rank < self.top_k
+
+            output[kept_images[sel], cl, rank[sel]] = torch.cat((scores[keep[sel]].unsqueeze(1), boxes[keep[sel]]), 1)
 
         return output
 
@@ -197,21 +210,81 @@ class PriorBox(object):
         for k, fmap in enumerate(self.feature_maps):
             feath = fmap[0]
             featw = fmap[1]
-            for i, j in product(range(feath), range(featw)):
-                f_kw = self.imw / self.steps[k]
-                f_kh = self.imh / self.steps[k]
 
-                cx = (j + 0.5) / f_kw
-                cy = (i + 0.5) / f_kh
+            f_kw = self.imw / self.steps[k]
+            f_kh = self.imh / self.steps[k]
+
+            s_kw = self.min_sizes[k] / self.imw
+            s_kh = self.min_sizes[k] / self.imh
 
-                s_kw = self.min_sizes[k] / self.imw
-                s_kh = self.min_sizes[k] / self.imh
+            # Anchors in row-major (i, j) order, computed in double like the
+            # python floats they replace and rounded to float32 at the end
+            cx = ((torch.arange(featw, dtype=torch.float64) + 0.5) / f_kw).view(1, featw).expand(feath, featw)
+            cy = ((torch.arange(feath, dtype=torch.float64) + 0.5) / f_kh).view(feath, 1).expand(feath, featw)
 
-                mean += [cx, cy, s_kw, s_kh]
+            mean.append(torch.stack((cx, cy, torch.full_like(cx, s_kw), torch.full_like(cy, s_kh)), dim=2).view(-1, 4))
 
-        output = torch.FloatTensor(mean).view(-1, 4)
+        output = torch.cat(mean, 0).float()
         
         if self.clip:
             output.clamp_(max=1, min=0)
         
         return output
+
+
+if __name__ == '__main__':
+
+    # python -m detectors.s3fd.box_utils: checks that Detect.forward keeps the same
+    # boxes as the original per-image, per-class loop over nms()
+
+    import sys
+
+    def detect_per_image(detect, loc_data, conf_data, prior_data):
+
+        num = loc_data.size(0)
+        num_priors = prior_data.size(0)
+
+        conf_preds = conf_data.view(num, num_priors, detect.num_classes).transpose(2, 1)
+        output = torch.zeros(num, detect.num_classes, detect.top_k, 5)
+
+        for i in range(num):
+            boxes = decode(loc_data[i], prior_data, detect.variance)
+            conf_scores = conf_preds[i].clone()
+
+            for cl in range(1, detect.num_classes):
+                c_mask = conf_scores[cl].gt(detect.conf_thresh)
+                scores = conf_scores[cl][c_mask]
+                boxes_ = boxes[c_mask.unsqueeze(1).expand_as(boxes)].view(-1, 4)
+                ids, count = nms(boxes_, scores, detect.nms_thresh, detect.nms_top_k)
+                count = min(count, detect.top_k)
+
+                output[i, cl, :count] = torch.cat((scores[ids[:count]].unsqueeze(1), boxes_[ids[:count]]), 1)
+
+        return output
+
+    failed = 0
+
+    for seed, (num, num_priors, top_k, nms_top_k) in enumerate([(1, 500, 750, 5000), (4, 3000, 750, 5000), (3, 3000, 20, 200), (2, 100, 750, 5000)]):
+
+        gen = torch.Generator().manual_seed(seed)
+
+        # Priors clustered in a few spots so that many boxes overlap
+        centres = torch.rand(8, 2, generator=gen)
+        priors = torch.cat((centres[torch.randint(0, 8, (num_priors,), generator=gen)] + 0.02 * torch.randn(num_priors, 2, generator=gen),
+                            0.05 + 0.2 * torch.rand(num_priors, 2, generator=gen)), 1)
+        loc = 0.5 * torch.randn(num, num_priors, 4, generator=gen)
+        # Distinct scores: the order in which boxes of equal score are taken is not
+        # defined by either implementation
+        conf = torch.softmax(1.5 * torch.randn(num, num_priors, 2, generator=gen), 2)
+        if seed == 3:
+            conf[1] = torch.tensor([1.0, 0.0])  # an image without any detection
+
+        detect = Detect(top_k=top_k, nms_top_k=nms_top_k)
+        out = detect.forward(loc, conf, priors)
+        ref = detect_per_image(detect, loc, conf, priors)
+
+        same = torch.equal(out, ref)
+        print('%d images, %4d priors, top_k %3d: %d boxes kept, %s' % (num, num_priors, top_k, int(ref[:, 1, :, 0].gt(0).sum()), 'identical' if same else 'DIFFERENT'))
+        failed += not same
+
+    sys.exit(1 if failed else 0)
@@ -1,8 +1,10 @@
+import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
 from .box_utils import Detect, PriorBox
+from .onnx_utils import onnx_session
 
 
 class L2Norm(nn.Module):
@@ -105,9 +107,11 @@ class S3FDNet(nn.Module):
 
         self.softmax = nn.Softmax(dim=-1)
         self.detect = Detect()
+        self.priors_cache = {}
 
-    def forward(self, x):
-        size = x.size()[2:]
+    def forward_heads(self, x):
+        # Backbone and multibox heads: loc [N x P x 4], softmaxed conf [N x P x 2]
+        # and the spatial size of each of the six source layers
         sources = list()
         loc = list()
         conf = list()
@@ -161,14 +165,77 @@ class S3FDNet(nn.Module):
         loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
         conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
 
+        return loc.view(loc.size(0), -1, 4), self.softmax(conf.view(conf.size(0), -1, 2)), features_maps
+
+    def forward(self, x):
+        loc, conf, features_maps = self.forward_heads(x)
+
+        # self.priors points at the priors last used
+        self.priors = priors(self.priors_cache, x.size()[2:], features_maps, self.device)
+
+        return self.detect.forward(loc, conf, self.priors)
+
+
+def priors(priors_cache, size, features_maps, device):
+    # Priors only depend on the input size, so they are built once per size
+    key = (tuple(size), tuple(tuple(f) for f in features_maps))
+    if key not in priors_cache:
         with torch.no_grad():
-            self.priorbox = PriorBox(size, features_maps)
-            self.priors = self.priorbox.forward()
+            priors_cache[key] = PriorBox(size, features_maps).forward().to(device)
+    return priors_cache[key]
+
+
+def feature_map_sizes(h, w):
+    # Sizes of the six source layers of S3FDNet for an h x w input: stride 4 at
+    # conv3_3, then halved by the ceil-mode pool3, the pool4 and pool5 pools and
+    # the two stride 2 extra convolutions (which round up)
+    def sizes(n):
+        out = [n // 4]
+        out.append(-(-out[-1] // 2))
+        out.append(out[-1] // 2)
+        out.append(out[-1] // 2)
+        out.append(-(-out[-1] // 2))
+        out.append(-(-out[-1] // 2))
+        return out
+
+    return [[a, b] for a, b in zip(sizes(h), sizes(w))]
+
+
+class S3FDHeads(nn.Module):
+    # S3FDNet up to the heads, the part exported to ONNX
+
+    def __init__(self, net):
+        super(S3FDHeads, self).__init__()
+        self.net = net
 
-        output = self.detect.forward(
-            loc.view(loc.size(0), -1, 4),
-            self.softmax(conf.view(conf.size(0), -1, 2)),
-            self.priors.type(type(x.data)).to(self.device)
-        )
+    def forward(self, x):
+        loc, conf, _ = self.net.forward_heads(x)
+        return loc, conf
+
+
+class S3FDOnnx():
+    # S3FDNet with the backbone and heads run by ONNX Runtime from an exported
+    # S3FDHeads graph; priors and Detect stay in torch
+
+    def __init__(self, path, device='cpu', num_threads=0):
+
+        if not os.path.exists(path):
+            raise FileNotFoundError('%s not found, run export_onnx.py first' % path)
+
+        self.device = device
+        self.session = onnx_session(path, device, num_threads)
+        self.detect = Detect()
+        self.priors_cache = {}
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        loc, conf = self.session.run(None, {'image': x.detach().cpu().numpy()})
+        loc = torch.from_numpy(loc).to(x.device)
+        conf = torch.from_numpy(conf).to(x.device)
+
+        size = x.size()[2:]
+        self.priors = priors(self.priors_cache, size, feature_map_sizes(size[0], size[1]), self.device)
 
-        return output
+        return self.detect.forward(loc, conf, self.priors)
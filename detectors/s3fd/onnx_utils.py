@@ -0,0 +1,28 @@
+import os
+import torch
+
+
+def onnx_session(path, device='cpu', num_threads=0):
+    """ONNX Runtime session for the graph at path, with all graph optimizations,
+    and the CUDA provider when device is a GPU and onnxruntime-gpu is installed.
+    onnxruntime is only imported here, so it stays an optional dependency.
+    """
+
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    if num_threads > 0:
+        options.intra_op_num_threads = num_threads
+
+    device = torch.device(device)
+    providers = ['CPUExecutionProvider']
+
+    if device.type == 'cuda':
+        if 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, ('CUDAExecutionProvider', {'device_id': device.index or 0}))
+        else:
+            print('WARNING: onnxruntime has no CUDA provider, %s runs on the CPU' % os.path.basename(path))
+
+    return onnxruntime.InferenceSession(path, sess_options=options, providers=providers)
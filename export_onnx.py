@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+# Exports SyncNet and the S3FD backbone and heads to ONNX, for --backend onnx.
+# The graphs have dynamic batch (and, for video and images, time and spatial)
+# axes. With --check, the ONNX Runtime outputs are compared against torch.
+
+import argparse, os, sys
+import numpy
+import torch
+
+from SyncNetModel import S
+from SyncNetOnnx import GRAPHS, onnx_dir, export_syncnet, export_graph, run_session
+from detectors.s3fd import PATH_WEIGHT, PATH_ONNX
+from detectors.s3fd.onnx_utils import onnx_session
+from detectors.s3fd.nets import S3FDNet, S3FDHeads
+
+# ==================== PARSE ARGUMENT ====================
+
+parser = argparse.ArgumentParser(description = "ONNX export");
+parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
+parser.add_argument('--output_dir', type=str, default='', help='Directory for the SyncNet graphs, next to the model as <model>_onnx by default');
+parser.add_argument('--skip_s3fd', action='store_true', help='Only export SyncNet');
+parser.add_argument('--opset', type=int, default=17, help='ONNX opset version');
+parser.add_argument('--check', action='store_true', help='Compare ONNX Runtime against torch on random inputs');
+opt = parser.parse_args();
+
+output_dir = opt.output_dir or onnx_dir(opt.initial_model)
+
+# ==================== SYNCNET ====================
+
+model = S(num_layers_in_fc_layers = 1024);
+model.load_state_dict(torch.load(opt.initial_model, map_location='cpu'));
+model.eval();
+
+export_syncnet(model, output_dir, opset=opt.opset)
+print('SyncNet graphs written to %s' % output_dir)
+
+# ==================== S3FD ====================
+
+if not opt.skip_s3fd:
+
+    net = S3FDNet(device='cpu')
+    net.load_state_dict(torch.load(PATH_WEIGHT, map_location='cpu'))
+
+    export_graph(S3FDHeads(net), (torch.zeros(1,3,240,320),), PATH_ONNX, ['image'], ['loc','conf'],
+                 {'image':{0:'batch', 2:'height', 3:'width'}, 'loc':{0:'batch', 1:'priors'}, 'conf':{0:'batch', 1:'priors'}}, opt.opset)
+    print('S3FD graph written to %s' % PATH_ONNX)
+
+# ==================== CHECK ====================
+
+if opt.check:
+
+    failed = 0
+    inputs = {'video': torch.randn(2,3,12,224,224)*50, 'mfcc': torch.randn(7,1,13,20)*10}
+
+    with torch.no_grad():
+        for name, (method, input_name, axes) in GRAPHS.items():
+            x    = inputs[input_name]
+            ref  = getattr(model,method)(x)
+            out  = run_session(onnx_session(os.path.join(output_dir,name+'.onnx')), x)
+            diff = (out-ref).abs().max().item()/max(ref.abs().max().item(),1e-6)
+            print('%-8s %s: max relative diff %.3g' % (name, tuple(out.shape), diff))
+            failed += not diff < 1e-3
+
+        if not opt.skip_s3fd:
+            session = onnx_session(PATH_ONNX)
+            x = torch.randn(2,3,180,250)*50
+            for ref, out in zip(S3FDHeads(net)(x), session.run(None, {'image': x.numpy()})):
+                diff = numpy.abs(out-ref.numpy()).max()
+                print('s3fd     %s: max abs diff %.3g' % (tuple(out.shape), diff))
+                failed += not diff < 1e-3
+
+    sys.exit(1 if failed else 0)
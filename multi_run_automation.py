@@ -7,6 +7,8 @@ import time
 import sys
 from pathlib import Path
 import glob
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ==================== 基础配置 ====================
 # 日志目录
@@ -48,8 +50,8 @@ def get_video_files(input_dir, recursive=True):
     video_files = sorted(list(set(video_files)))
     return video_files
 
-def run_command(cmd, log_file):
-    """执行命令并记录日志"""
+def run_command(cmd, log_file, echo=True):
+    """执行命令并记录日志（echo=False 时不输出到控制台，供并行处理使用）"""
     # 记录命令执行信息
     log_content = f"\n{'='*50}\n执行命令: {' '.join(cmd)}\n开始时间: {time.ctime()}\n{'='*50}\n"
     log_file.write(log_content)
@@ -73,8 +75,9 @@ def run_command(cmd, log_file):
             log_file.write(line)
             log_file.flush()
             # 同时输出到控制台
-            sys.stdout.write(line)
-            sys.stdout.flush()
+            if echo:
+                sys.stdout.write(line)
+                sys.stdout.flush()
 
     # 记录执行结果
     return_code = process.returncode
@@ -85,6 +88,23 @@ def run_command(cmd, log_file):
 
     return return_code
 
+def make_references(video_files):
+    """用文件名（不含路径和后缀）作为 reference，重名时追加序号，保证每个视频的工作目录互不冲突"""
+    references = []
+    used = set()
+    for videofile in video_files:
+        reference = Path(videofile).stem
+        # 替换特殊字符（避免目录创建失败）
+        reference = reference.replace('/', '_').replace('\\', '_').replace(':', '_').replace('*', '_').replace('?', '_').replace('"', '_').replace('<', '_').replace('>', '_').replace('|', '_')
+        unique = reference
+        suffix = 2
+        while unique in used:
+            unique = f"{reference}_{suffix}"
+            suffix += 1
+        used.add(unique)
+        references.append(unique)
+    return references
+
 # ==================== 参数解析 ====================
 def parse_args():
     parser = argparse.ArgumentParser(description="SyncNet 批量全管线自动化脚本",
@@ -111,6 +131,18 @@ def parse_args():
                         help="[pipeline] 允许的最大检测失败次数")
     parser.add_argument("--min_face_size", type=int, default=100,
                         help="[pipeline] 最小人脸尺寸（像素）")
+    parser.add_argument("--facedet_batch", type=int, default=8,
+                        help="[pipeline] 人脸检测每次前向的帧数")
+    parser.add_argument("--facedet_interval", type=int, default=1,
+                        help="[pipeline] 每隔 N 帧做一次人脸检测，中间帧用跟踪补全（1 表示逐帧检测）")
+    parser.add_argument("--track_min_score", type=float, default=0.7,
+                        help="[pipeline] 跟踪匹配得分下限，低于该值时重新检测")
+    parser.add_argument("--resume", action="store_true",
+                        help="[pipeline] 保留上次的输出，仅重跑输入或参数有变化的阶段")
+    parser.add_argument("--frame_store", action="store_true",
+                        help="[pipeline/visualise] 将视频一次性解码为内存映射的原始帧文件，代替 pyframes 下的 JPEG")
+    parser.add_argument("--crop_audio", action="store_true",
+                        help="[pipeline] 将每条轨迹的音频封装进裁剪视频（run_syncnet.py 直接切分原始音频，不需要它）")
     
     # ---------------- run_syncnet.py 特有参数 ----------------
     parser.add_argument("--initial_model", type=str, default="data/syncnet_v2.model",
@@ -119,6 +151,20 @@ def parse_args():
                         help="[syncnet] 批处理大小")
     parser.add_argument("--vshift", type=int, default=15,
                         help="[syncnet] 视频偏移量")
+    parser.add_argument("--cache_dir", type=str, default="",
+                        help="[syncnet] 特征缓存目录，为空则不使用缓存")
+    parser.add_argument("--cache_size", type=float, default=10,
+                        help="[syncnet] 特征缓存上限（GB），超出时淘汰最久未使用的条目")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "int8"],
+                        help="[syncnet] 推理精度：bf16 自动混合精度 / int8 全连接层动态量化（仅 CPU）")
+    
+    # ---------------- 推理设备参数 ----------------
+    parser.add_argument("--device", type=str, default="cuda",
+                        help="[pipeline/syncnet] 推理设备（cuda / cuda:N / cpu）")
+    parser.add_argument("--num_threads", type=int, default=0,
+                        help="[pipeline/syncnet] CPU 推理线程数，0 表示使用 torch 默认值")
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx"],
+                        help="[pipeline/syncnet] 推理后端：torch / onnx（ONNX Runtime，需先运行 export_onnx.py）")
     
     # ---------------- run_visualise.py 特有参数 ----------------
     parser.add_argument("--frame_rate", type=int, default=25,
@@ -129,9 +175,115 @@ def parse_args():
                         help="某个脚本执行失败时，是否跳过该视频的后续脚本")
     parser.add_argument("--skip-video-failed", action="store_true",
                         help="某个视频处理失败时，是否跳过下一个视频")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="同时处理的视频数；大于 1 时各视频的输出只写入各自的日志文件")
 
     return parser.parse_args()
 
+# ==================== 单个视频处理 ====================
+def build_commands(args, videofile, reference):
+    """构造单个视频需要依次执行的脚本命令"""
+    # run_pipeline.py 命令
+    pipeline_cmd = [
+        sys.executable, "run_pipeline.py",
+        "--videofile", videofile,
+        "--reference", reference,
+        "--data_dir", args.data_dir,
+        "--facedet_scale", str(args.facedet_scale),
+        "--crop_scale", str(args.crop_scale),
+        "--min_track", str(args.min_track),
+        "--frame_rate", str(args.frame_rate),
+        "--num_failed_det", str(args.num_failed_det),
+        "--min_face_size", str(args.min_face_size),
+        "--facedet_batch", str(args.facedet_batch),
+        "--facedet_interval", str(args.facedet_interval),
+        "--track_min_score", str(args.track_min_score),
+        "--device", args.device,
+        "--num_threads", str(args.num_threads),
+        "--backend", args.backend
+    ]
+    if args.frame_store:
+        pipeline_cmd.append("--frame_store")
+    if args.crop_audio:
+        pipeline_cmd.append("--crop_audio")
+    if args.resume:
+        pipeline_cmd.append("--resume")
+
+    # run_syncnet.py 命令
+    syncnet_cmd = [
+        sys.executable, "run_syncnet.py",
+        "--videofile", videofile,
+        "--reference", reference,
+        "--data_dir", args.data_dir,
+        "--initial_model", args.initial_model,
+        "--batch_size", str(args.batch_size),
+        "--vshift", str(args.vshift),
+        "--cache_dir", args.cache_dir,
+        "--cache_size", str(args.cache_size),
+        "--precision", args.precision,
+        "--device", args.device,
+        "--num_threads", str(args.num_threads),
+        "--backend", args.backend
+    ]
+
+    # run_visualise.py 命令
+    visualise_cmd = [
+        sys.executable, "run_visualise.py",
+        "--videofile", videofile,
+        "--reference", reference,
+        "--data_dir", args.data_dir,
+        "--frame_rate", str(args.frame_rate)
+    ]
+
+    return [
+        ("run_pipeline.py", pipeline_cmd),
+        ("run_syncnet.py", syncnet_cmd),
+        ("run_visualise.py", visualise_cmd)
+    ]
+
+def process_video(args, videofile, reference, log_path, echo, stop_event):
+    """依次执行单个视频的全部脚本，输出写入该视频自己的日志文件，返回 (状态, 耗时)"""
+    if stop_event.is_set():
+        return "skipped", 0.0
+
+    start_time = time.time()
+    video_success = True
+
+    with open(log_path, "a", encoding="utf-8") as log_file:
+        log_file.write(f"===== SyncNet 视频处理日志 =====\n文件路径: {videofile}\nReference: {reference}\n开始时间: {time.ctime()}\n\n")
+        log_file.flush()
+
+        for script_name, cmd in build_commands(args, videofile, reference):
+            log_file.write(f"\n\n========== 开始执行 {script_name} ==========\n")
+            log_file.flush()
+
+            # 执行命令
+            return_code = run_command(cmd, log_file, echo=echo)
+
+            # 检查执行结果
+            if return_code != 0:
+                video_success = False
+                log_file.write(f"\n❌ {script_name} 执行失败 (视频: {videofile})\n")
+                log_file.flush()
+                if echo:
+                    print(f"\n❌ {script_name} 执行失败 (视频: {videofile})")
+
+                # 若开启skip-failed，跳过该视频后续脚本
+                if args.skip_failed:
+                    log_file.write(f"\n⚠️  已开启--skip-failed，跳过该视频后续脚本\n")
+                    log_file.flush()
+                    if echo:
+                        print(f"\n⚠️  已开启--skip-failed，跳过该视频后续脚本")
+                    break
+
+        log_file.write(f"\n{'✅ 处理完成' if video_success else '❌ 处理失败'}，结束时间: {time.ctime()}\n")
+
+    # 若开启skip-video-failed，在此处立即停止，后续尚未开始的视频不再执行
+    if not video_success and args.skip_video_failed:
+        stop_event.set()
+
+    return ("success" if video_success else "failed"), time.time() - start_time
+
 # ==================== 主执行逻辑 ====================
 def main():
     # 1. 解析参数
@@ -140,16 +292,20 @@ def main():
     # 2. 初始化日志目录
     init_log_dir()
     
-    # 3. 生成批量日志文件名（带时间戳）
+    # 3. 生成批量日志文件名（带时间戳），每个视频的日志放在同名目录下
     timestamp = get_timestamp()
     batch_log_file_path = LOG_DIR / f"syncnet_batch_automation_{timestamp}.log"
+    video_log_dir = LOG_DIR / f"syncnet_batch_automation_{timestamp}"
+    video_log_dir.mkdir(exist_ok=True, parents=True)
     
     # 4. 获取所有视频文件
     video_files = get_video_files(args.input_dir, not args.no_recursive)
     if not video_files:
         print(f"❌ 在目录 {args.input_dir} 下未找到支持的视频文件（支持格式：{SUPPORTED_VIDEO_EXT}）")
         sys.exit(1)
-    print(f"✅ 共找到 {len(video_files)} 个视频文件，开始批量处理...")
+    references = make_references(video_files)
+    workers = max(args.workers, 1)
+    print(f"✅ 共找到 {len(video_files)} 个视频文件，开始批量处理（并行数: {workers}）...")
     
     # 5. 打开批量日志文件
     with open(batch_log_file_path, "a", encoding="utf-8") as batch_log_file:
@@ -160,117 +316,73 @@ def main():
         batch_log_file.write(f"递归查找: {not args.no_recursive}\n")
         batch_log_file.write(f"输出根目录: {args.data_dir}\n")
         batch_log_file.write(f"视频文件数量: {len(video_files)}\n")
+        batch_log_file.write(f"并行数: {workers}\n")
         batch_log_file.write(f"日志文件: {batch_log_file_path}\n")
+        batch_log_file.write(f"单个视频日志目录: {video_log_dir}\n")
         batch_log_file.write(f"==========================================\n\n")
         batch_log_file.flush()
 
-        # 6. 遍历处理每个视频
+        # 6. 处理每个视频：workers 个视频同时执行，各自写独立日志；
+        #    只有串行时才把脚本输出同步到控制台，避免多个视频的输出交错
         total_success = 0
         total_failed = 0
+        total_skipped = 0
         failed_videos = []
-        
-        for idx, videofile in enumerate(video_files, 1):
-            # 生成reference（视频文件名，不含路径和后缀）
-            video_path = Path(videofile)
-            reference = video_path.stem  # 核心：用文件名作为reference
-            # 替换特殊字符（避免目录创建失败）
-            reference = reference.replace('/', '_').replace('\\', '_').replace(':', '_').replace('*', '_').replace('?', '_').replace('"', '_').replace('<', '_').replace('>', '_').replace('|', '_')
-            
-            batch_log_file.write(f"\n\n{'='*60}\n开始处理第 {idx}/{len(video_files)} 个视频:\n文件路径: {videofile}\nReference: {reference}\n{'='*60}\n")
+        durations = {}
+        stop_event = threading.Event()
+        stop_logged = False
+        batch_start = time.time()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for idx, (videofile, reference) in enumerate(zip(video_files, references), 1):
+                log_path = video_log_dir / f"{reference}.log"
+                batch_log_file.write(f"第 {idx}/{len(video_files)} 个视频: {videofile} (reference: {reference}, 日志: {log_path})\n")
+                futures[executor.submit(process_video, args, videofile, reference, log_path, workers == 1, stop_event)] = (idx, videofile, reference, log_path)
             batch_log_file.flush()
-            print(f"\n\n📌 开始处理第 {idx}/{len(video_files)} 个视频: {videofile} (reference: {reference})")
-
-            # 标记当前视频是否处理成功
-            video_success = True
-
-            # 构造每个脚本的执行命令
-            # 6.1 run_pipeline.py 命令
-            pipeline_cmd = [
-                sys.executable, "run_pipeline.py",
-                "--videofile", videofile,
-                "--reference", reference,
-                "--data_dir", args.data_dir,
-                "--facedet_scale", str(args.facedet_scale),
-                "--crop_scale", str(args.crop_scale),
-                "--min_track", str(args.min_track),
-                "--frame_rate", str(args.frame_rate),
-                "--num_failed_det", str(args.num_failed_det),
-                "--min_face_size", str(args.min_face_size)
-            ]
-
-            # 6.2 run_syncnet.py 命令
-            syncnet_cmd = [
-                sys.executable, "run_syncnet.py",
-                "--videofile", videofile,
-                "--reference", reference,
-                "--data_dir", args.data_dir,
-                "--initial_model", args.initial_model,
-                "--batch_size", str(args.batch_size),
-                "--vshift", str(args.vshift)
-            ]
-
-            # 6.3 run_visualise.py 命令
-            visualise_cmd = [
-                sys.executable, "run_visualise.py",
-                "--videofile", videofile,
-                "--reference", reference,
-                "--data_dir", args.data_dir,
-                "--frame_rate", str(args.frame_rate)
-            ]
-
-            # 按顺序执行脚本
-            scripts_cmds = [
-                ("run_pipeline.py", pipeline_cmd),
-                ("run_syncnet.py", syncnet_cmd),
-                ("run_visualise.py", visualise_cmd)
-            ]
-
-            for script_name, cmd in scripts_cmds:
-                batch_log_file.write(f"\n\n========== 开始执行 {script_name} ==========\n")
+
+            for future in as_completed(futures):
+                idx, videofile, reference, log_path = futures[future]
+                status, duration = future.result()
+
+                # 统计结果
+                if status == "success":
+                    total_success += 1
+                    durations[videofile] = duration
+                    batch_log_file.write(f"\n✅ 视频 {videofile} 处理完成 (耗时: {duration:.1f}秒)\n")
+                    print(f"\n✅ [{idx}/{len(video_files)}] 视频 {videofile} 处理完成 (耗时: {duration:.1f}秒)")
+                elif status == "failed":
+                    total_failed += 1
+                    failed_videos.append(videofile)
+                    durations[videofile] = duration
+                    batch_log_file.write(f"\n❌ 视频 {videofile} 处理失败，详见 {log_path}\n")
+                    print(f"\n❌ [{idx}/{len(video_files)}] 视频 {videofile} 处理失败，详见 {log_path}")
+
+                    # 若开启skip-video-failed，不再开始新的视频（已在执行的视频会继续完成）
+                    if args.skip_video_failed and not stop_logged:
+                        stop_logged = True
+                        batch_log_file.write(f"\n⚠️  已开启--skip-video-failed，终止批量处理\n")
+                        print(f"\n⚠️  已开启--skip-video-failed，终止批量处理")
+                else:
+                    total_skipped += 1
                 batch_log_file.flush()
-                
-                # 执行命令
-                return_code = run_command(cmd, batch_log_file)
-                
-                # 检查执行结果
-                if return_code != 0:
-                    video_success = False
-                    batch_log_file.write(f"\n❌ {script_name} 执行失败 (视频: {videofile})\n")
-                    batch_log_file.flush()
-                    print(f"\n❌ {script_name} 执行失败 (视频: {videofile})")
-                    
-                    # 若开启skip-failed，跳过该视频后续脚本
-                    if args.skip_failed:
-                        batch_log_file.write(f"\n⚠️  已开启--skip-failed，跳过该视频后续脚本\n")
-                        batch_log_file.flush()
-                        print(f"\n⚠️  已开启--skip-failed，跳过该视频后续脚本")
-                        break
-
-            # 统计结果
-            if video_success:
-                total_success += 1
-                batch_log_file.write(f"\n✅ 视频 {videofile} 处理完成\n")
-                print(f"\n✅ 视频 {videofile} 处理完成")
-            else:
-                total_failed += 1
-                failed_videos.append(videofile)
-                batch_log_file.write(f"\n❌ 视频 {videofile} 处理失败\n")
-                print(f"\n❌ 视频 {videofile} 处理失败")
-                
-                # 若开启skip-video-failed，跳过下一个视频
-                if args.skip_video_failed:
-                    batch_log_file.write(f"\n⚠️  已开启--skip-video-failed，终止批量处理\n")
-                    batch_log_file.flush()
-                    print(f"\n⚠️  已开启--skip-video-failed，终止批量处理")
-                    break
 
         # 7. 批量处理完成，写入汇总信息
-        batch_log_file.write(f"\n\n===== 批量处理汇总 =====\n")
-        batch_log_file.write(f"总视频数: {len(video_files)}\n")
-        batch_log_file.write(f"成功数: {total_success}\n")
-        batch_log_file.write(f"失败数: {total_failed}\n")
+        total_time = time.time() - batch_start
+        summary = [
+            f"总视频数: {len(video_files)}",
+            f"成功数: {total_success}",
+            f"失败数: {total_failed}",
+            f"未执行数: {total_skipped}",
+            f"总耗时: {total_time:.1f}秒",
+            f"单个视频累计耗时: {sum(durations.values()):.1f}秒",
+        ]
         if failed_videos:
-            batch_log_file.write(f"失败视频列表: {failed_videos}\n")
+            summary.append(f"失败视频列表: {sorted(failed_videos)}")
+
+        batch_log_file.write(f"\n\n===== 批量处理汇总 =====\n")
+        for line in summary:
+            batch_log_file.write(line + "\n")
         batch_log_file.write(f"完成时间: {time.ctime()}\n")
         batch_log_file.write(f"批量日志文件: {batch_log_file_path}\n")
         batch_log_file.write(f"========================\n")
@@ -278,14 +390,16 @@ def main():
 
         # 控制台输出汇总
         print(f"\n\n===== 批量处理汇总 =====")
-        print(f"总视频数: {len(video_files)}")
-        print(f"成功数: {total_success}")
-        print(f"失败数: {total_failed}")
-        if failed_videos:
-            print(f"失败视频列表: {failed_videos}")
+        for line in summary:
+            print(line)
         print(f"批量日志文件: {batch_log_file_path}")
+        print(f"单个视频日志目录: {video_log_dir}")
         print(f"========================")
 
+    # 有失败的视频时返回非零退出码，供 batch_syncnet.sh 统计
+    if total_failed:
+        sys.exit(1)
+
 if __name__ == "__main__":
     try:
         main()
@@ -87,6 +87,18 @@ def parse_args():
                         help="[pipeline] 允许的最大检测失败次数")
     parser.add_argument("--min_face_size", type=int, default=100,
                         help="[pipeline] 最小人脸尺寸（像素）")
+    parser.add_argument("--facedet_batch", type=int, default=8,
+                        help="[pipeline] 人脸检测每次前向的帧数")
+    parser.add_argument("--facedet_interval", type=int, default=1,
+                        help="[pipeline] 每隔 N 帧做一次人脸检测，中间帧用跟踪补全（1 表示逐帧检测）")
+    parser.add_argument("--track_min_score", type=float, default=0.7,
+                        help="[pipeline] 跟踪匹配得分下限，低于该值时重新检测")
+    parser.add_argument("--resume", action="store_true",
+                        help="[pipeline] 保留上次的输出，仅重跑输入或参数有变化的阶段")
+    parser.add_argument("--frame_store", action="store_true",
+                        help="[pipeline/visualise] 将视频一次性解码为内存映射的原始帧文件，代替 pyframes 下的 JPEG")
+    parser.add_argument("--crop_audio", action="store_true",
+                        help="[pipeline] 将每条轨迹的音频封装进裁剪视频（run_syncnet.py 直接切分原始音频，不需要它）")
     
     # ---------------- run_syncnet.py 特有参数 ----------------
     parser.add_argument("--initial_model", type=str, default="data/syncnet_v2.model",
@@ -95,6 +107,20 @@ def parse_args():
                         help="[syncnet] 批处理大小")
     parser.add_argument("--vshift", type=int, default=15,
                         help="[syncnet] 视频偏移量")
+    parser.add_argument("--cache_dir", type=str, default="",
+                        help="[syncnet] 特征缓存目录，为空则不使用缓存")
+    parser.add_argument("--cache_size", type=float, default=10,
+                        help="[syncnet] 特征缓存上限（GB），超出时淘汰最久未使用的条目")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "int8"],
+                        help="[syncnet] 推理精度：bf16 自动混合精度 / int8 全连接层动态量化（仅 CPU）")
+    
+    # ---------------- 推理设备参数 ----------------
+    parser.add_argument("--device", type=str, default="cuda",
+                        help="[pipeline/syncnet] 推理设备（cuda / cuda:N / cpu）")
+    parser.add_argument("--num_threads", type=int, default=0,
+                        help="[pipeline/syncnet] CPU 推理线程数，0 表示使用 torch 默认值")
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx"],
+                        help="[pipeline/syncnet] 推理后端：torch / onnx（ONNX Runtime，需先运行 export_onnx.py）")
     
     # ---------------- run_visualise.py 特有参数 ----------------
     parser.add_argument("--frame_rate", type=int, default=25,
@@ -145,8 +171,20 @@ def main():
             "--min_track", str(args.min_track),
             "--frame_rate", str(args.frame_rate),
             "--num_failed_det", str(args.num_failed_det),
-            "--min_face_size", str(args.min_face_size)
+            "--min_face_size", str(args.min_face_size),
+            "--facedet_batch", str(args.facedet_batch),
+            "--facedet_interval", str(args.facedet_interval),
+            "--track_min_score", str(args.track_min_score),
+            "--device", args.device,
+            "--num_threads", str(args.num_threads),
+            "--backend", args.backend
         ]
+        if args.frame_store:
+            pipeline_cmd.append("--frame_store")
+        if args.crop_audio:
+            pipeline_cmd.append("--crop_audio")
+        if args.resume:
+            pipeline_cmd.append("--resume")
 
         # 5.2 run_syncnet.py 命令
         syncnet_cmd = [
@@ -156,7 +194,13 @@ def main():
             "--data_dir", args.data_dir,
             "--initial_model", args.initial_model,
             "--batch_size", str(args.batch_size),
-            "--vshift", str(args.vshift)
+            "--vshift", str(args.vshift),
+            "--cache_dir", args.cache_dir,
+            "--cache_size", str(args.cache_size),
+            "--precision", args.precision,
+            "--device", args.device,
+            "--num_threads", str(args.num_threads),
+            "--backend", args.backend
         ]
 
         # 5.3 run_visualise.py 命令
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import sys, time, os, argparse, traceback
+
+from SyncNetRunner import SyncNetRunner, parse_runner_options
+from multi_run_automation import get_video_files, make_references
+
+# ==================== PARSE ARGUMENT ====================
+
+parser = argparse.ArgumentParser(description = "SyncNet batch runner, loads the models once for all videos",
+                                 epilog = "Any other option of run_pipeline.py or run_syncnet.py is passed on to every video.");
+parser.add_argument('videos', type=str, nargs='*', help='Input video files');
+parser.add_argument('--input_dir', type=str, default='', help='Also process every video found under this directory');
+parser.add_argument('--no_recursive', action='store_true', help='Only look at the top level of --input_dir');
+
+if '-h' in sys.argv[1:] or '--help' in sys.argv[1:]:
+    parser.print_help()
+    sys.exit(0)
+
+# Pipeline and SyncNet options first, so that their values are not taken for videos
+opt, rest = parse_runner_options(sys.argv[1:]);
+args = parser.parse_args(rest);
+
+videos = list(args.videos)
+if args.input_dir:
+    videos += get_video_files(args.input_dir, not args.no_recursive)
+
+# Each file once, in the order given
+videos = list(dict.fromkeys(os.path.abspath(videofile) for videofile in videos))
+
+if not videos:
+    parser.error('no input videos')
+
+# ==================== RUN ====================
+
+runner = SyncNetRunner(opt)
+
+failed = []
+start_time = time.time()
+
+for videofile, reference in zip(videos, make_references(videos)):
+
+    video_time = time.time()
+
+    try:
+        results = runner.run(videofile, reference)
+    except Exception:
+        traceback.print_exc()
+        failed.append(videofile)
+        print('%s - failed'%videofile)
+        continue
+
+    for tidx, result in enumerate(results):
+        print('%s - track %d: AV offset %d, confidence %.3f'%(reference,tidx,result['offset'],result['conf']))
+
+    print('%s - %d tracks (%.2f sec)'%(videofile,len(results),time.time()-video_time))
+
+print('Processed %d videos, %d failed (%.2f sec)'%(len(videos),len(failed),time.time()-start_time))
+
+for videofile in failed:
+    print('  failed: %s'%videofile)
+
+sys.exit(1 if failed else 0)
@@ -1,11 +1,11 @@
 #!/usr/bin/python
 
-import sys, time, os, pdb, argparse, pickle, subprocess, glob, cv2
+import sys, time, os, pdb, argparse, pickle, subprocess, cv2, threading, queue, json, hashlib
 import numpy as np
 from shutil import rmtree
 
 import scenedetect
-from scenedetect.video_manager import VideoManager
+from scenedetect.video_manager import VideoManager, compute_downscale_factor
 from scenedetect.scene_manager import SceneManager
 from scenedetect.frame_timecode import FrameTimecode
 from scenedetect.stats_manager import StatsManager
@@ -16,6 +16,7 @@ from scipy.io import wavfile
 from scipy import signal
 
 from detectors import S3FD
+from FrameStore import FrameStore, open_frames
 
 # ========== ========== ========== ==========
 # # PARSE ARGS
@@ -31,13 +32,25 @@ parser.add_argument('--min_track',      type=int, default=100,  help='Minimum fa
 parser.add_argument('--frame_rate',     type=int, default=25,   help='Frame rate');
 parser.add_argument('--num_failed_det', type=int, default=25,   help='Number of missed detections allowed before tracking is stopped');
 parser.add_argument('--min_face_size',  type=int, default=100,  help='Minimum face size in pixels');
-opt = parser.parse_args();
-
-setattr(opt,'avi_dir',os.path.join(opt.data_dir,'pyavi'))
-setattr(opt,'tmp_dir',os.path.join(opt.data_dir,'pytmp'))
-setattr(opt,'work_dir',os.path.join(opt.data_dir,'pywork'))
-setattr(opt,'crop_dir',os.path.join(opt.data_dir,'pycrop'))
-setattr(opt,'frames_dir',os.path.join(opt.data_dir,'pyframes'))
+parser.add_argument('--facedet_batch',  type=int, default=8,    help='Number of frames per face detection forward pass');
+parser.add_argument('--facedet_interval', type=int, default=1,  help='Run face detection every N frames and track faces in between, 1 detects on every frame');
+parser.add_argument('--resume',         action='store_true', help='Keep earlier outputs and rerun only the stages whose inputs or parameters changed');
+parser.add_argument('--frame_store',    action='store_true', help='Decode the video once into a memory-mapped raw frame store instead of dumping JPEGs to pyframes (needs H x W x 3 bytes per frame)');
+parser.add_argument('--crop_audio',     action='store_true', help='Mux the audio of each track into its crop; run_syncnet.py slices the source audio and does not need it');
+parser.add_argument('--track_min_score', type=float, default=0.7, help='Minimum template match score of tracked faces, face detection is rerun below it');
+parser.add_argument('--device',         type=str, default='cuda', help='Device for face detection (cuda, cuda:N or cpu)');
+parser.add_argument('--num_threads',    type=int, default=0,    help='Intra-op CPU threads for torch, 0 keeps the torch default');
+parser.add_argument('--backend',        type=str, default='torch', choices=['torch','onnx'], help='Run S3FD with torch, or with ONNX Runtime on the graph written by export_onnx.py');
+
+def set_dirs(opt):
+
+  setattr(opt,'avi_dir',os.path.join(opt.data_dir,'pyavi'))
+  setattr(opt,'tmp_dir',os.path.join(opt.data_dir,'pytmp'))
+  setattr(opt,'work_dir',os.path.join(opt.data_dir,'pywork'))
+  setattr(opt,'crop_dir',os.path.join(opt.data_dir,'pycrop'))
+  setattr(opt,'frames_dir',os.path.join(opt.data_dir,'pyframes'))
+
+  return opt
 
 # ========== ========== ========== ==========
 # # IOU FUNCTION
@@ -108,13 +121,7 @@ def track_shot(opt,scenefaces):
 # # VIDEO CROP AND SAVE
 # ========== ========== ========== ==========
         
-def crop_video(opt,track,cropfile):
-
-  flist = glob.glob(os.path.join(opt.frames_dir,opt.reference,'*.jpg'))
-  flist.sort()
-
-  fourcc = cv2.VideoWriter_fourcc(*'XVID')
-  vOut = cv2.VideoWriter(cropfile+'t.avi', fourcc, opt.frame_rate, (224,224))
+def smooth_track(opt,track):
 
   dets = {'x':[], 'y':[], 's':[]}
 
@@ -129,29 +136,79 @@ def crop_video(opt,track,cropfile):
   dets['x'] = signal.medfilt(dets['x'],kernel_size=13)
   dets['y'] = signal.medfilt(dets['y'],kernel_size=13)
 
-  for fidx, frame in enumerate(track['frame']):
+  return dets
 
-    cs  = opt.crop_scale
+def crop_face(opt,image,dets,fidx):
 
-    bs  = dets['s'][fidx]   # Detection box size
-    bsi = int(bs*(1+2*cs))  # Pad videos by this amount 
+  # Same crop as slicing the frame padded by bsi on every side with grey (110),
+  # but only the crop window is allocated and the part inside the frame copied
 
-    image = cv2.imread(flist[frame])
-    
-    frame = np.pad(image,((bsi,bsi),(bsi,bsi),(0,0)), 'constant', constant_values=(110,110))
-    my  = dets['y'][fidx]+bsi  # BBox center Y
-    mx  = dets['x'][fidx]+bsi  # BBox center X
+  cs  = opt.crop_scale
 
-    face = frame[int(my-bs):int(my+bs*(1+2*cs)),int(mx-bs*(1+cs)):int(mx+bs*(1+cs))]
-    
-    vOut.write(cv2.resize(face,(224,224)))
+  bs  = dets['s'][fidx]   # Detection box size
+  bsi = int(bs*(1+2*cs))  # Pad videos by this amount 
+
+  h, w = image.shape[:2]
+
+  my  = dets['y'][fidx]+bsi  # BBox center Y
+  mx  = dets['x'][fidx]+bsi  # BBox center X
+
+  # Crop window in padded coordinates, clamped to the padded frame
+  y1, y2 = min(max(int(my-bs),0),h+2*bsi), min(max(int(my+bs*(1+2*cs)),0),h+2*bsi)
+  x1, x2 = min(max(int(mx-bs*(1+cs)),0),w+2*bsi), min(max(int(mx+bs*(1+cs)),0),w+2*bsi)
+
+  face = np.full((max(y2-y1,0),max(x2-x1,0),3), 110, dtype=image.dtype)
+
+  iy1, iy2 = max(y1-bsi,0), min(y2-bsi,h)
+  ix1, ix2 = max(x1-bsi,0), min(x2-bsi,w)
+
+  if iy2 > iy1 and ix2 > ix1:
+    face[iy1+bsi-y1:iy2+bsi-y1,ix1+bsi-x1:ix2+bsi-x1] = image[iy1:iy2,ix1:ix2]
+
+  return cv2.resize(face,(224,224))
+
+def encode_crops(opt,jobs,errors):
+
+  # Background writer: (ii, path, face) appends a frame to crop ii, opening its
+  # writer on first use, and (ii, None, None) closes it. None stops the thread.
+
+  fourcc  = cv2.VideoWriter_fourcc(*'XVID')
+  writers = {}
+
+  while True:
+    job = jobs.get()
+    if job is None:
+      break
+    if errors:
+      continue
+
+    ii, path, face = job
+
+    try:
+      if path is None:
+        writers.pop(ii).release()
+      else:
+        if ii not in writers:
+          writers[ii] = cv2.VideoWriter(path, fourcc, opt.frame_rate, (224,224))
+        writers[ii].write(face)
+    except Exception as e:
+      errors.append(e)
+
+  for writer in writers.values():
+    writer.release()
+
+def crop_audio(opt,track,dets,cropfile):
+
+  if not opt.crop_audio:
+    os.replace(cropfile+'t.avi',cropfile+'.avi')
+    print('Written %s'%cropfile)
+    print('Mean pos: x %.2f y %.2f s %.2f'%(np.mean(dets['x']),np.mean(dets['y']),np.mean(dets['s'])))
+    return {'track':track, 'proc_track':dets}
 
   audiotmp    = os.path.join(opt.tmp_dir,opt.reference,'audio.wav')
   audiostart  = (track['frame'][0])/opt.frame_rate
   audioend    = (track['frame'][-1]+1)/opt.frame_rate
 
-  vOut.release()
-
   # ========== CROP AUDIO FILE ==========
 
   command = ("ffmpeg -y -i %s -ss %.3f -to %.3f %s" % (os.path.join(opt.avi_dir,opt.reference,'audio.wav'),audiostart,audioend,audiotmp)) 
@@ -178,35 +235,165 @@ def crop_video(opt,track,cropfile):
 
   return {'track':track, 'proc_track':dets}
 
+def crop_video(opt,tracks,cropfiles):
+
+  # Crops every track in one pass over the frames: each frame is decoded once
+  # and fanned out to the tracks covering it, while a background thread encodes
+
+  frames = open_frames(os.path.join(opt.frames_dir,opt.reference))
+
+  dets   = [ smooth_track(opt,track) for track in tracks ]
+  starts = [ int(track['frame'][0]) for track in tracks ]
+  ends   = [ int(track['frame'][-1]) for track in tracks ]
+
+  jobs   = queue.Queue(maxsize=64)
+  errors = []
+  worker = threading.Thread(target=encode_crops, args=(opt,jobs,errors))
+  worker.start()
+
+  try:
+    for frame in range(min(starts,default=0),max(ends,default=-1)+1):
+
+      active = [ ii for ii in range(len(tracks)) if starts[ii] <= frame <= ends[ii] ]
+      if active == []:
+        continue
+
+      image = frames[frame]
+
+      for ii in active:
+        jobs.put((ii, cropfiles[ii]+'t.avi', crop_face(opt,image,dets[ii],frame-starts[ii])))
+        if frame == ends[ii]:
+          jobs.put((ii, None, None))
+  finally:
+    jobs.put(None)
+    worker.join()
+
+  if errors:
+    raise errors[0]
+
+  return [ crop_audio(opt,track,dets[ii],cropfiles[ii]) for ii, track in enumerate(tracks) ]
+
 # ========== ========== ========== ==========
 # # FACE DETECTION
 # ========== ========== ========== ==========
 
-def inference_video(opt):
+def track_gray(opt,image):
+
+  return cv2.resize(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), None, fx=opt.facedet_scale, fy=opt.facedet_scale, interpolation=cv2.INTER_AREA)
+
+def propagate_faces(opt,key_gray,key_bboxes,gray,bboxes):
+
+  # Move each face from the last detection to the best normalised cross-correlation
+  # match of its keyframe template, searching within half a face size around its
+  # previous position. Returns None if any face cannot be matched confidently.
+
+  sc      = opt.facedet_scale
+  h, w    = gray.shape
+  tracked = []
+
+  for key_bbox, bbox in zip(key_bboxes, bboxes):
+
+    tx1, ty1 = max(int(key_bbox[0]*sc),0), max(int(key_bbox[1]*sc),0)
+    tx2, ty2 = min(int(key_bbox[2]*sc),w), min(int(key_bbox[3]*sc),h)
+
+    if tx2-tx1 < 4 or ty2-ty1 < 4:
+      return None
+
+    tmpl = key_gray[ty1:ty2,tx1:tx2]
+
+    # Position of the template's top-left corner at the previous frame
+    px   = tx1 + (bbox[0]-key_bbox[0])*sc
+    py   = ty1 + (bbox[1]-key_bbox[1])*sc
+    m    = max(tx2-tx1,ty2-ty1)/2
+
+    sx1, sy1 = max(int(px-m),0), max(int(py-m),0)
+    sx2, sy2 = min(int(px+m)+tx2-tx1,w), min(int(py+m)+ty2-ty1,h)
+
+    if sx2-sx1 < tx2-tx1 or sy2-sy1 < ty2-ty1:
+      return None
+
+    res = cv2.matchTemplate(gray[sy1:sy2,sx1:sx2], tmpl, cv2.TM_CCOEFF_NORMED)
+    _, score, _, loc = cv2.minMaxLoc(res)
+
+    if score < opt.track_min_score:
+      return None
+
+    dx = (sx1+loc[0]-tx1)/sc
+    dy = (sy1+loc[1]-ty1)/sc
 
-  DET = S3FD(device='cuda')
+    tracked.append(key_bbox + np.array([dx,dy,dx,dy,0]))
 
-  flist = glob.glob(os.path.join(opt.frames_dir,opt.reference,'*.jpg'))
-  flist.sort()
+  return np.array(tracked).reshape(-1,5)
+
+def inference_video(opt,DET=None,content_vals=None):
+
+  # If content_vals is a list, the scene change metric of every frame is
+  # appended to it on the way, for scene_detect
+
+  if DET is None:
+    DET = S3FD(device=opt.device, num_threads=opt.num_threads, backend=opt.backend)
+
+  frames = open_frames(os.path.join(opt.frames_dir,opt.reference))
 
   dets = []
-      
-  for fidx, fname in enumerate(flist):
+
+  # Keyframes of each chunk go through the detector as one batch; the frames in
+  # between are tracked from the last detection, and detected on their own
+  # whenever tracking fails
+  interval = max(opt.facedet_interval,1)
+  step     = opt.facedet_batch*interval
+
+  # Template and faces of the last detection, which tracking starts from
+  key_gray, key_bboxes = None, None
+
+  # HSV of the previous frame for the scene change metric, as ContentDetector.last_hsv
+  last_hsv = None
+
+  for bidx in range(0,len(frames),step):
 
     start_time = time.time()
-    
-    image = cv2.imread(fname)
 
-    image_np = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    bboxes = DET.detect_faces(image_np, conf_th=0.9, scales=[opt.facedet_scale])
+    images  = [ cv2.cvtColor(frames[fidx], cv2.COLOR_BGR2RGB) for fidx in range(bidx,min(bidx+step,len(frames))) ]
+    keyidx  = list(range(0,len(images),interval))
+    keydets = dict(zip(keyidx, DET.detect_faces_batch([images[ii] for ii in keyidx], conf_th=0.9, scales=[opt.facedet_scale])))
+
+    bboxes_batch = []
+
+    for iidx, image in enumerate(images):
+
+      gray   = track_gray(opt,image) if interval > 1 else None
+      bboxes = keydets.get(iidx)
+
+      tracked = False
+
+      if bboxes is None and key_bboxes is not None:
+        bboxes  = propagate_faces(opt,key_gray,key_bboxes,gray,bboxes_batch[-1])
+        tracked = bboxes is not None
+
+      # Keyframes, and frames that could not be tracked (or have no detection to
+      # track from) are detected and become the new template
+      if bboxes is None:
+        bboxes = DET.detect_faces(image, conf_th=0.9, scales=[opt.facedet_scale])
 
-    dets.append([]);
-    for bbox in bboxes:
-      dets[-1].append({'frame':fidx, 'bbox':(bbox[:-1]).tolist(), 'conf':bbox[-1]})
+      if not tracked:
+        key_gray, key_bboxes = gray, bboxes
+
+      bboxes_batch.append(bboxes)
+
+      if content_vals is not None:
+        hsv = content_hsv(image)
+        content_vals.append(content_val(last_hsv,hsv) if last_hsv is not None else 0.0)
+        last_hsv = hsv
 
     elapsed_time = time.time() - start_time
 
-    print('%s-%05d; %d dets; %.2f Hz' % (os.path.join(opt.avi_dir,opt.reference,'video.avi'),fidx,len(dets[-1]),(1/elapsed_time))) 
+    for fidx, bboxes in enumerate(bboxes_batch, bidx):
+
+      dets.append([]);
+      for bbox in bboxes:
+        dets[-1].append({'frame':fidx, 'bbox':(bbox[:-1]).tolist(), 'conf':bbox[-1]})
+
+      print('%s-%05d; %d dets; %.2f Hz' % (os.path.join(opt.avi_dir,opt.reference,'video.avi'),fidx,len(dets[-1]),(len(images)/elapsed_time))) 
 
   savepath = os.path.join(opt.work_dir,opt.reference,'faces.pckl')
 
@@ -219,27 +406,69 @@ def inference_video(opt):
 # # SCENE DETECTION
 # ========== ========== ========== ==========
 
-def scene_detect(opt):
+def content_hsv(image):
 
-  video_manager = VideoManager([os.path.join(opt.avi_dir,opt.reference,'video.avi')])
-  stats_manager = StatsManager()
-  scene_manager = SceneManager(stats_manager)
-  # Add ContentDetector algorithm (constructor takes detector options like threshold).
-  scene_manager.add_detector(ContentDetector())
-  base_timecode = video_manager.get_base_timecode()
+  # HSV of an RGB frame, subsampled by the factor scenedetect's VideoManager uses
+  # by default for the frame width
 
-  video_manager.set_downscale_factor()
+  factor = compute_downscale_factor(image.shape[1])
 
-  video_manager.start()
+  return cv2.cvtColor(image[::factor,::factor], cv2.COLOR_RGB2HSV).astype(np.int32)
 
-  scene_manager.detect_scenes(frame_source=video_manager)
+def content_val(last_hsv,hsv):
 
-  scene_list = scene_manager.get_scene_list(base_timecode)
+  # ContentDetector's content_val: mean absolute difference of each HSV channel
+  # between consecutive frames, averaged over the three channels
 
-  savepath = os.path.join(opt.work_dir,opt.reference,'scene.pckl')
+  delta = np.abs(hsv-last_hsv).reshape(-1,3).sum(0) / float(hsv.shape[0]*hsv.shape[1])
+
+  return sum(delta.tolist()) / 3.0
+
+def scenes_from_content(opt,content_vals,threshold=30.0,min_scene_len=15):
+
+  # Same cuts and (start, end) timecodes as ContentDetector with its defaults
+
+  cuts = []
+
+  for frame_num, val in enumerate(content_vals):
+    if frame_num > 0 and val >= threshold and (cuts == [] or frame_num - cuts[-1] >= min_scene_len):
+      cuts.append(frame_num)
+
+  base_timecode = FrameTimecode(0, fps=float(opt.frame_rate))
+  bounds        = [0] + cuts + [len(content_vals)]
+
+  return [ (base_timecode+bounds[ii], base_timecode+bounds[ii+1]) for ii in range(len(bounds)-1) ]
+
+def scene_detect(opt,content_vals=None):
+
+  # With content_vals from inference_video the scenes come from those, otherwise
+  # the video is decoded again with scenedetect
+
+  if content_vals:
+
+    scene_list = scenes_from_content(opt,content_vals)
+
+  else:
 
-  if scene_list == []:
-    scene_list = [(video_manager.get_base_timecode(),video_manager.get_current_timecode())]
+    video_manager = VideoManager([os.path.join(opt.avi_dir,opt.reference,'video.avi')])
+    stats_manager = StatsManager()
+    scene_manager = SceneManager(stats_manager)
+    # Add ContentDetector algorithm (constructor takes detector options like threshold).
+    scene_manager.add_detector(ContentDetector())
+    base_timecode = video_manager.get_base_timecode()
+
+    video_manager.set_downscale_factor()
+
+    video_manager.start()
+
+    scene_manager.detect_scenes(frame_source=video_manager)
+
+    scene_list = scene_manager.get_scene_list(base_timecode)
+
+    if scene_list == []:
+      scene_list = [(video_manager.get_base_timecode(),video_manager.get_current_timecode())]
+
+  savepath = os.path.join(opt.work_dir,opt.reference,'scene.pckl')
 
   with open(savepath, 'wb') as fil:
     pickle.dump(scene_list, fil)
@@ -249,74 +478,189 @@ def scene_detect(opt):
   return scene_list
     
 
+# ========== ========== ========== ==========
+# # STAGE CHECKPOINTS
+# ========== ========== ========== ==========
+
+# pywork/<reference>/manifest.json records, for each finished stage, a key
+# hashing its parameters and the keys of the stages it reads from, so a stage
+# is rerun when anything upstream of it changed. Entries also keep the
+# parameters and input keys they were computed from
+
+def load_manifest(opt):
+
+  path = os.path.join(opt.work_dir,opt.reference,'manifest.json')
+
+  if not os.path.exists(path):
+    return {}
+
+  with open(path, 'r') as fil:
+    return json.load(fil)
+
+def save_manifest(opt,manifest):
+
+  path = os.path.join(opt.work_dir,opt.reference,'manifest.json')
+
+  with open(path+'.tmp', 'w') as fil:
+    json.dump(manifest, fil, indent=2, sort_keys=True)
+
+  os.replace(path+'.tmp', path)
+
+def stage_entry(name,params,deps):
+
+  inputs = { dep['name']:dep['key'] for dep in deps }
+  key    = hashlib.sha1(json.dumps([name,params,inputs], sort_keys=True).encode()).hexdigest()
+
+  return {'name':name, 'key':key, 'params':params, 'inputs':inputs}
+
+def stage_done(opt,manifest,stage,outputs):
+
+  done = manifest.get(stage['name'],{}).get('key') == stage['key'] and all(os.path.exists(path) for path in outputs)
+
+  if done:
+    print('%s - %s stage up to date, skipping'%(opt.reference,stage['name']))
+
+  return done
+
+def begin_stage(opt,manifest,stage):
+
+  # Forget the stage before touching its outputs, so a crash leaves it invalid
+  manifest.pop(stage['name'],None)
+  save_manifest(opt,manifest)
+
+def end_stage(opt,manifest,stage):
+
+  manifest[stage['name']] = dict(stage, time=time.time())
+  save_manifest(opt,manifest)
+
 # ========== ========== ========== ==========
 # # EXECUTE DEMO
 # ========== ========== ========== ==========
 
-# ========== DELETE EXISTING DIRECTORIES ==========
+def pipeline(opt,DET=None):
 
-if os.path.exists(os.path.join(opt.work_dir,opt.reference)):
-  rmtree(os.path.join(opt.work_dir,opt.reference))
+  # Runs every stage for opt.videofile / opt.reference. DET is an S3FD instance
+  # to reuse across videos, one is constructed if needed when it is None
 
-if os.path.exists(os.path.join(opt.crop_dir,opt.reference)):
-  rmtree(os.path.join(opt.crop_dir,opt.reference))
+  # ========== DELETE EXISTING DIRECTORIES ==========
 
-if os.path.exists(os.path.join(opt.avi_dir,opt.reference)):
-  rmtree(os.path.join(opt.avi_dir,opt.reference))
+  # With --resume the outputs of earlier runs are kept and only the stages whose
+  # inputs or parameters changed are recomputed; pytmp is always cleared
 
-if os.path.exists(os.path.join(opt.frames_dir,opt.reference)):
-  rmtree(os.path.join(opt.frames_dir,opt.reference))
+  for work_dir in [opt.work_dir,opt.crop_dir,opt.avi_dir,opt.frames_dir,opt.tmp_dir]:
+    if os.path.exists(os.path.join(work_dir,opt.reference)) and (not opt.resume or work_dir == opt.tmp_dir):
+      rmtree(os.path.join(work_dir,opt.reference))
 
-if os.path.exists(os.path.join(opt.tmp_dir,opt.reference)):
-  rmtree(os.path.join(opt.tmp_dir,opt.reference))
+  # ========== MAKE NEW DIRECTORIES ==========
+
+  os.makedirs(os.path.join(opt.work_dir,opt.reference),exist_ok=True)
+  os.makedirs(os.path.join(opt.crop_dir,opt.reference),exist_ok=True)
+  os.makedirs(os.path.join(opt.avi_dir,opt.reference),exist_ok=True)
+  os.makedirs(os.path.join(opt.frames_dir,opt.reference),exist_ok=True)
+  os.makedirs(os.path.join(opt.tmp_dir,opt.reference),exist_ok=True)
+
+  manifest = load_manifest(opt)
 
-# ========== MAKE NEW DIRECTORIES ==========
+  # ========== CONVERT VIDEO AND EXTRACT FRAMES ==========
 
-os.makedirs(os.path.join(opt.work_dir,opt.reference))
-os.makedirs(os.path.join(opt.crop_dir,opt.reference))
-os.makedirs(os.path.join(opt.avi_dir,opt.reference))
-os.makedirs(os.path.join(opt.frames_dir,opt.reference))
-os.makedirs(os.path.join(opt.tmp_dir,opt.reference))
+  videostat   = os.stat(opt.videofile)
+  convert_stage = stage_entry('convert',{'videofile':os.path.abspath(opt.videofile),'size':videostat.st_size,'mtime':videostat.st_mtime},[])
 
-# ========== CONVERT VIDEO AND EXTRACT FRAMES ==========
+  if not stage_done(opt,manifest,convert_stage,[os.path.join(opt.avi_dir,opt.reference,'video.avi')]):
+    begin_stage(opt,manifest,convert_stage)
 
-command = ("ffmpeg -y -i %s -qscale:v 2 -async 1 -r 25 %s" % (opt.videofile,os.path.join(opt.avi_dir,opt.reference,'video.avi')))
-output = subprocess.call(command, shell=True, stdout=None)
+    command = ("ffmpeg -y -i %s -qscale:v 2 -async 1 -r 25 %s" % (opt.videofile,os.path.join(opt.avi_dir,opt.reference,'video.avi')))
+    if subprocess.call(command, shell=True, stdout=None) != 0:
+      raise RuntimeError('ffmpeg failed to convert %s'%opt.videofile)
 
-command = ("ffmpeg -y -i %s -qscale:v 2 -threads 1 -f image2 %s" % (os.path.join(opt.avi_dir,opt.reference,'video.avi'),os.path.join(opt.frames_dir,opt.reference,'%06d.jpg'))) 
-output = subprocess.call(command, shell=True, stdout=None)
+    end_stage(opt,manifest,convert_stage)
 
-command = ("ffmpeg -y -i %s -ac 1 -vn -acodec pcm_s16le -ar 16000 %s" % (os.path.join(opt.avi_dir,opt.reference,'video.avi'),os.path.join(opt.avi_dir,opt.reference,'audio.wav'))) 
-output = subprocess.call(command, shell=True, stdout=None)
+  frames_stage  = stage_entry('frames',{'frame_store':opt.frame_store},[convert_stage])
+  frames_out  = os.path.join(opt.frames_dir,opt.reference,'frames.raw' if opt.frame_store else '000001.jpg')
 
-# ========== FACE DETECTION ==========
+  if not stage_done(opt,manifest,frames_stage,[frames_out]):
+    begin_stage(opt,manifest,frames_stage)
 
-faces = inference_video(opt)
+    rmtree(os.path.join(opt.frames_dir,opt.reference))
+    os.makedirs(os.path.join(opt.frames_dir,opt.reference))
 
-# ========== SCENE DETECTION ==========
+    if opt.frame_store:
+      FrameStore.create(os.path.join(opt.avi_dir,opt.reference,'video.avi'),os.path.join(opt.frames_dir,opt.reference,'frames.raw'),fps=opt.frame_rate)
+    else:
+      command = ("ffmpeg -y -i %s -qscale:v 2 -threads 1 -f image2 %s" % (os.path.join(opt.avi_dir,opt.reference,'video.avi'),os.path.join(opt.frames_dir,opt.reference,'%06d.jpg'))) 
+      if subprocess.call(command, shell=True, stdout=None) != 0:
+        raise RuntimeError('ffmpeg failed to extract the frames of %s'%opt.videofile)
 
-scene = scene_detect(opt)
+    end_stage(opt,manifest,frames_stage)
 
-# ========== FACE TRACKING ==========
+  audio_stage   = stage_entry('audio',{},[convert_stage])
 
-alltracks = []
-vidtracks = []
+  if not stage_done(opt,manifest,audio_stage,[os.path.join(opt.avi_dir,opt.reference,'audio.wav')]):
+    begin_stage(opt,manifest,audio_stage)
 
-for shot in scene:
+    command = ("ffmpeg -y -i %s -ac 1 -vn -acodec pcm_s16le -ar 16000 %s" % (os.path.join(opt.avi_dir,opt.reference,'video.avi'),os.path.join(opt.avi_dir,opt.reference,'audio.wav'))) 
+    if subprocess.call(command, shell=True, stdout=None) != 0:
+      raise RuntimeError('ffmpeg failed to extract the audio of %s'%opt.videofile)
 
-  if shot[1].frame_num - shot[0].frame_num >= opt.min_track :
-    alltracks.extend(track_shot(opt,faces[shot[0].frame_num:shot[1].frame_num]))
+    end_stage(opt,manifest,audio_stage)
 
-# ========== FACE TRACK CROP ==========
+  # ========== FACE DETECTION ==========
 
-for ii, track in enumerate(alltracks):
-  vidtracks.append(crop_video(opt,track,os.path.join(opt.crop_dir,opt.reference,'%05d'%ii)))
+  # Scene change metric collected during face detection, so scene detection does
+  # not decode the video again. Empty if detection is skipped on resume.
+  content_vals = []
 
-# ========== SAVE RESULTS ==========
+  faces_stage   = stage_entry('faces',{'facedet_scale':opt.facedet_scale,'facedet_interval':opt.facedet_interval,'track_min_score':opt.track_min_score},[frames_stage])
 
-savepath = os.path.join(opt.work_dir,opt.reference,'tracks.pckl')
+  if stage_done(opt,manifest,faces_stage,[os.path.join(opt.work_dir,opt.reference,'faces.pckl')]):
+    with open(os.path.join(opt.work_dir,opt.reference,'faces.pckl'), 'rb') as fil:
+      faces = pickle.load(fil)
+  else:
+    begin_stage(opt,manifest,faces_stage)
+    faces = inference_video(opt,DET,content_vals)
+    end_stage(opt,manifest,faces_stage)
 
-with open(savepath, 'wb') as fil:
-  pickle.dump(vidtracks, fil)
+  # ========== SCENE DETECTION ==========
+
+  scene_stage   = stage_entry('scene',{},[convert_stage])
+
+  if stage_done(opt,manifest,scene_stage,[os.path.join(opt.work_dir,opt.reference,'scene.pckl')]):
+    with open(os.path.join(opt.work_dir,opt.reference,'scene.pckl'), 'rb') as fil:
+      scene = pickle.load(fil)
+  else:
+    begin_stage(opt,manifest,scene_stage)
+    scene = scene_detect(opt,content_vals)
+    end_stage(opt,manifest,scene_stage)
+
+  # ========== FACE TRACKING AND CROP ==========
+
+  crop_stage    = stage_entry('crop',{'min_track':opt.min_track,'num_failed_det':opt.num_failed_det,'min_face_size':opt.min_face_size,'crop_scale':opt.crop_scale,'frame_rate':opt.frame_rate,'crop_audio':opt.crop_audio},[faces_stage,scene_stage,audio_stage])
+
+  if not stage_done(opt,manifest,crop_stage,[os.path.join(opt.work_dir,opt.reference,'tracks.pckl')]):
+    begin_stage(opt,manifest,crop_stage)
+
+    rmtree(os.path.join(opt.crop_dir,opt.reference))
+    os.makedirs(os.path.join(opt.crop_dir,opt.reference))
+
+    alltracks = []
+
+    for shot in scene:
+
+      if shot[1].frame_num - shot[0].frame_num >= opt.min_track :
+        alltracks.extend(track_shot(opt,faces[shot[0].frame_num:shot[1].frame_num]))
+
+    vidtracks = crop_video(opt,alltracks,[ os.path.join(opt.crop_dir,opt.reference,'%05d'%ii) for ii in range(len(alltracks)) ])
+
+    # ========== SAVE RESULTS ==========
+
+    savepath = os.path.join(opt.work_dir,opt.reference,'tracks.pckl')
+
+    with open(savepath, 'wb') as fil:
+      pickle.dump(vidtracks, fil)
+
+    end_stage(opt,manifest,crop_stage)
+
+  rmtree(os.path.join(opt.tmp_dir,opt.reference))
 
-rmtree(os.path.join(opt.tmp_dir,opt.reference))
+if __name__ == '__main__':
+  pipeline(set_dirs(parser.parse_args()))
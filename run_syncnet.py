@@ -11,35 +11,65 @@ parser = argparse.ArgumentParser(description = "SyncNet");
 parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
 parser.add_argument('--batch_size', type=int, default='20', help='');
 parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--device', type=str, default='cuda', help='cuda, cuda:N or cpu');
+parser.add_argument('--num_threads', type=int, default='0', help='Intra-op CPU threads, 0 keeps the torch default');
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32','bf16','int8'], help='SyncNet inference precision: bf16 autocast, or int8 dynamic quantization of the fc layers (cpu only)');
+parser.add_argument('--backend', type=str, default='torch', choices=['torch','onnx'], help='Run SyncNet with torch, or with ONNX Runtime on the graphs written by export_onnx.py');
+parser.add_argument('--stream', action='store_true', help='Stream frames and audio with O(batch_size) memory, for long tracks');
+parser.add_argument('--cache_dir', type=str, default='', help='Directory for cached embeddings, empty disables the cache');
+parser.add_argument('--cache_size', type=float, default='10', help='Maximum cache size in GB, least recently used entries are evicted');
 parser.add_argument('--data_dir', type=str, default='data/work', help='');
 parser.add_argument('--videofile', type=str, default='', help='');
 parser.add_argument('--reference', type=str, default='', help='');
-opt = parser.parse_args();
 
-setattr(opt,'avi_dir',os.path.join(opt.data_dir,'pyavi'))
-setattr(opt,'tmp_dir',os.path.join(opt.data_dir,'pytmp'))
-setattr(opt,'work_dir',os.path.join(opt.data_dir,'pywork'))
-setattr(opt,'crop_dir',os.path.join(opt.data_dir,'pycrop'))
+def set_dirs(opt):
 
+    setattr(opt,'avi_dir',os.path.join(opt.data_dir,'pyavi'))
+    setattr(opt,'tmp_dir',os.path.join(opt.data_dir,'pytmp'))
+    setattr(opt,'work_dir',os.path.join(opt.data_dir,'pywork'))
+    setattr(opt,'crop_dir',os.path.join(opt.data_dir,'pycrop'))
 
-# ==================== LOAD MODEL AND FILE LIST ====================
+    return opt
 
-s = SyncNetInstance();
 
-s.loadParameters(opt.initial_model);
-print("Model %s loaded."%opt.initial_model);
+# ==================== GET OFFSETS ====================
 
-flist = glob.glob(os.path.join(opt.crop_dir,opt.reference,'0*.avi'))
-flist.sort()
+def evaluate_crops(opt, s):
 
-# ==================== GET OFFSETS ====================
+    # Scores every face track crop of opt.reference with the loaded SyncNetInstance
+    # s and writes the distance matrices to activesd.pckl. The audio features come
+    # from the source audio, computed once for all tracks not in the cache, and
+    # the windows of all tracks are run through the network together.
+
+    flist = glob.glob(os.path.join(opt.crop_dir,opt.reference,'0*.avi'))
+    flist.sort()
+
+    audio      = lambda crops: s.track_audio(opt, len(flist), crops)
+    audio_keys = s.track_audio_keys(opt, len(flist))
+
+    offsets, confs, dists = [], [], []
+    for offset, conf, dist in s.evaluate_many(opt, flist, audio, audio_keys):
+        offsets.append(offset)
+        confs.append(conf)
+        dists.append(dist)
+
+    # ==================== PRINT RESULTS TO FILE ====================
+
+    with open(os.path.join(opt.work_dir,opt.reference,'activesd.pckl'), 'wb') as fil:
+        pickle.dump(dists, fil)
+
+    return offsets, confs, dists
+
+
+if __name__ == '__main__':
+
+    opt = set_dirs(parser.parse_args());
+
+    # ==================== LOAD MODEL ====================
+
+    s = SyncNetInstance(device=opt.device, num_threads=opt.num_threads, precision=opt.precision, backend=opt.backend);
 
-dists = []
-for idx, fname in enumerate(flist):
-    offset, conf, dist = s.evaluate(opt,videofile=fname)
-    dists.append(dist)
-      
-# ==================== PRINT RESULTS TO FILE ====================
+    s.loadParameters(opt.initial_model);
+    print("Model %s loaded."%opt.initial_model);
 
-with open(os.path.join(opt.work_dir,opt.reference,'activesd.pckl'), 'wb') as fil:
-    pickle.dump(dists, fil)
+    evaluate_crops(opt, s)
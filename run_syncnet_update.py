@@ -12,6 +12,13 @@ parser = argparse.ArgumentParser(description = "SyncNet");
 parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
 parser.add_argument('--batch_size', type=int, default='20', help='');
 parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--device', type=str, default='cuda', help='cuda, cuda:N or cpu');
+parser.add_argument('--num_threads', type=int, default='0', help='Intra-op CPU threads, 0 keeps the torch default');
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32','bf16','int8'], help='SyncNet inference precision: bf16 autocast, or int8 dynamic quantization of the fc layers (cpu only)');
+parser.add_argument('--backend', type=str, default='torch', choices=['torch','onnx'], help='Run SyncNet with torch, or with ONNX Runtime on the graphs written by export_onnx.py');
+parser.add_argument('--stream', action='store_true', help='Stream frames and audio with O(batch_size) memory, for long tracks');
+parser.add_argument('--cache_dir', type=str, default='', help='Directory for cached embeddings, empty disables the cache');
+parser.add_argument('--cache_size', type=float, default='10', help='Maximum cache size in GB, least recently used entries are evicted');
 parser.add_argument('--data_dir', type=str, default='data/work', help='');
 parser.add_argument('--videofile', type=str, default='', help='');
 parser.add_argument('--reference', type=str, default='', help='');
@@ -25,7 +32,7 @@ setattr(opt,'crop_dir',os.path.join(opt.data_dir,'pycrop'))
 
 # ==================== LOAD MODEL AND FILE LIST ====================
 
-s = SyncNetInstance();
+s = SyncNetInstance(device=opt.device, num_threads=opt.num_threads, precision=opt.precision, backend=opt.backend);
 
 s.loadParameters(opt.initial_model);
 print("Model %s loaded."%opt.initial_model);
@@ -33,6 +40,14 @@ print("Model %s loaded."%opt.initial_model);
 flist = glob.glob(os.path.join(opt.crop_dir,opt.reference,'0*.avi'))
 flist.sort()
 
+# 音频特征：对 pyavi 下的原始音频只计算一次，再按每条轨迹的帧范围切分；
+# 缓存命中的轨迹不计算音频特征，缓存键只用 audio.wav 的哈希和帧范围
+audio      = lambda crops: s.track_audio(opt, len(flist), crops)
+audio_keys = s.track_audio_keys(opt, len(flist))
+
+# 所有轨迹的窗口一起组成满批次送入网络，再按轨迹拆分结果
+results = s.evaluate_many(opt, flist, audio, audio_keys)
+
 # ==================== GET OFFSETS ====================
 
 dists = []
@@ -41,7 +56,7 @@ confidences_list = []  # 新增：存储每个裁剪视频的置信度
 
 for idx, fname in enumerate(flist):
     print(f"\nProcessing crop video {idx}: {fname}")
-    offset, conf, dist = s.evaluate(opt,videofile=fname)
+    offset, conf, dist = results[idx]
     dists.append(dist)
     offsets_list.append(offset)  # 保存偏移值
     confidences_list.append(conf)  # 保存置信度
@@ -3,11 +3,13 @@
 
 import torch
 import numpy
-import time, pdb, argparse, subprocess, pickle, os, glob
+import time, pdb, argparse, subprocess, pickle, os, threading, queue
 import cv2
 
 from scipy import signal
 
+from FrameStore import open_frames
+
 # ==================== PARSE ARGUMENT ====================
 
 parser = argparse.ArgumentParser(description = "SyncNet");
@@ -31,20 +33,19 @@ with open(os.path.join(opt.work_dir,opt.reference,'tracks.pckl'), 'rb') as fil:
 with open(os.path.join(opt.work_dir,opt.reference,'activesd.pckl'), 'rb') as fil:
     dists = pickle.load(fil, encoding='latin1')
 
-flist = glob.glob(os.path.join(opt.frames_dir,opt.reference,'*.jpg'))
-flist.sort()
+frames = open_frames(os.path.join(opt.frames_dir,opt.reference))
 
 # ==================== SMOOTH FACES ====================
 
-faces = [[] for i in range(len(flist))]
+faces = [[] for i in range(len(frames))]
 
 for tidx, track in enumerate(tracks):
 
-	mean_dists 	=  numpy.mean(numpy.stack(dists[tidx],1),1)
+	mean_dists 	= numpy.mean(dists[tidx],0)
 	minidx 		= numpy.argmin(mean_dists,0)
 	minval 		= mean_dists[minidx] 
 	
-	fdist   	= numpy.stack([dist[minidx] for dist in dists[tidx]])
+	fdist   	= dists[tidx][:,minidx]
 	fdist   	= numpy.pad(fdist, (3,3), 'constant', constant_values=10)
 
 	fconf   = numpy.median(mean_dists) - fdist
@@ -55,34 +56,99 @@ for tidx, track in enumerate(tracks):
 
 # ==================== ADD DETECTIONS TO VIDEO ====================
 
-first_image = cv2.imread(flist[0])
+# Frames are decoded, drawn and encoded on three overlapping threads. The drawn
+# frames go straight into one ffmpeg process, which encodes them and muxes the
+# audio in the same step.
 
-fw = first_image.shape[1]
-fh = first_image.shape[0]
+def read_frames(frames,decoded,errors):
 
-fourcc = cv2.VideoWriter_fourcc(*'XVID')
-vOut = cv2.VideoWriter(os.path.join(opt.avi_dir,opt.reference,'video_only.avi'), fourcc, opt.frame_rate, (fw,fh))
+	try:
+		for fidx in range(len(frames)):
+			if errors:
+				break
+			decoded.put(frames[fidx])
+	except Exception as e:
+		errors.append(e)
+	finally:
+		decoded.put(None)
 
-for fidx, fname in enumerate(flist):
+def write_frames(proc,drawn,errors):
 
-	image = cv2.imread(fname)
+	while True:
+		image = drawn.get()
+		if image is None:
+			break
+		if errors:
+			continue
 
-	for face in faces[fidx]:
+		try:
+			proc.stdin.write(image.tobytes())
+		except Exception as e:
+			errors.append(e)
 
-		clr = max(min(face['conf']*25,255),0)
+	try:
+		proc.stdin.close()
+	except Exception as e:
+		errors.append(e)
 
-		cv2.rectangle(image,(int(face['x']-face['s']),int(face['y']-face['s'])),(int(face['x']+face['s']),int(face['y']+face['s'])),(0,clr,255-clr),3)
-		cv2.putText(image,'Track %d, Conf %.3f'%(face['track'],face['conf']), (int(face['x']-face['s']),int(face['y']-face['s'])),cv2.FONT_HERSHEY_SIMPLEX,0.5,(255,255,255),2)
+def draw_faces(image,faces):
 
-	vOut.write(image)
+	for face in faces:
 
-	print('Frame %d'%fidx)
+		clr = float(max(min(face['conf']*25,255),0))
 
-vOut.release()
+		cv2.rectangle(image,(int(face['x']-face['s']),int(face['y']-face['s'])),(int(face['x']+face['s']),int(face['y']+face['s'])),(0,clr,255-clr),3)
+		cv2.putText(image,'Track %d, Conf %.3f'%(face['track'],face['conf']), (int(face['x']-face['s']),int(face['y']-face['s'])),cv2.FONT_HERSHEY_SIMPLEX,0.5,(255,255,255),2)
 
-# ========== COMBINE AUDIO AND VIDEO FILES ==========
+	return image
 
-command = ("ffmpeg -y -i %s -i %s -c:v copy -c:a copy %s" % (os.path.join(opt.avi_dir,opt.reference,'video_only.avi'),os.path.join(opt.avi_dir,opt.reference,'audio.wav'),os.path.join(opt.avi_dir,opt.reference,'video_out.avi'))) #-async 1 
-output = subprocess.call(command, shell=True, stdout=None)
+first_image = frames[0]
 
+fw = first_image.shape[1]
+fh = first_image.shape[0]
 
+outfile = os.path.join(opt.avi_dir,opt.reference,'video_out.avi')
+
+command = ['ffmpeg','-y','-loglevel','error',
+           '-f','rawvideo','-pix_fmt','bgr24','-s','%dx%d'%(fw,fh),'-r',str(opt.frame_rate),'-i','pipe:0',
+           '-i',os.path.join(opt.avi_dir,opt.reference,'audio.wav'),
+           '-map','0:v:0','-map','1:a:0','-c:v','mpeg4','-vtag','XVID','-q:v','2','-c:a','copy',outfile]
+
+proc    = subprocess.Popen(command, stdin=subprocess.PIPE)
+decoded = queue.Queue(maxsize=32)
+drawn   = queue.Queue(maxsize=32)
+errors  = []
+
+reader = threading.Thread(target=read_frames, args=(frames,decoded,errors))
+writer = threading.Thread(target=write_frames, args=(proc,drawn,errors))
+reader.start()
+writer.start()
+
+tS    = time.time()
+count = 0
+
+try:
+	while True:
+		image = decoded.get()
+		if image is None:
+			break
+		if not errors:
+			drawn.put(draw_faces(image,faces[count]))
+		count += 1
+except Exception as e:
+	# Let the reader see the error and finish
+	errors.append(e)
+	while decoded.get() is not None:
+		pass
+finally:
+	drawn.put(None)
+	writer.join()
+	reader.join()
+
+if proc.wait() != 0 and not errors:
+	errors.append(RuntimeError('ffmpeg failed to write %s'%outfile))
+
+if errors:
+	raise errors[0]
+
+print('Written %s (%d frames, %.3f sec.)'%(outfile,count,time.time()-tS))